@@ -0,0 +1,58 @@
+"""Tail-latency benchmark for the shortener pool in bot.py, using fake providers."""
+import asyncio
+import random
+import time
+
+from bot import ShortenerPool, ShortenerProvider
+
+
+class FakeShortenerProvider(ShortenerProvider):
+    """Provider with simulated latency, used by benchmark_shortener()."""
+
+    def __init__(self, name, base_latency, spike_latency, spike_chance):
+        super().__init__(name, "http://fake.invalid/api", "fake")
+        self.base_latency = base_latency
+        self.spike_latency = spike_latency
+        self.spike_chance = spike_chance
+
+    def _request(self, long_url):
+        spiked = random.random() < self.spike_chance
+        time.sleep(self.spike_latency if spiked else self.base_latency * random.uniform(0.8, 1.2))
+        return {"status": "success", "shortenedUrl": f"https://{self.name}.invalid/{abs(hash(long_url))}"}
+
+
+def benchmark_shortener(requests_count=500):
+    """Compares tail latency of one provider against the hedged pool using fake providers.
+
+    Run with ``python bench_shortener.py``; nothing leaves the machine.
+    """
+    def make_providers():
+        return [
+            FakeShortenerProvider("fast", 0.02, 0.5, 0.03),
+            FakeShortenerProvider("backup", 0.04, 0.5, 0.03),
+        ]
+
+    async def measure(pool):
+        # Warm up so every provider has enough samples for a p95 hedge delay
+        for i in range(50):
+            await pool.shorten(f"https://t.me/benchmark?start=warmup_{i}")
+        samples = []
+        for i in range(requests_count):
+            started = time.perf_counter()
+            await pool.shorten(f"https://t.me/benchmark?start=solve_{i}")
+            samples.append(time.perf_counter() - started)
+        samples.sort()
+        return {q: samples[int(len(samples) * q) - 1] * 1000 for q in (0.5, 0.95, 0.99)}
+
+    scenarios = [
+        ("single provider", ShortenerPool(make_providers()[:1], hedge=False)),
+        ("pool, no hedging", ShortenerPool(make_providers(), hedge=False)),
+        ("pool, hedged", ShortenerPool(make_providers(), hedge=True)),
+    ]
+    for label, pool in scenarios:
+        result = asyncio.run(measure(pool))
+        print(f"{label:18} p50 {result[0.5]:7.1f} ms  p95 {result[0.95]:7.1f} ms  p99 {result[0.99]:7.1f} ms")
+
+
+if __name__ == '__main__':
+    benchmark_shortener()
@@ -1,84 +1,944 @@
 import os
+import sys
+import csv
+import time
+import random
+import json
+import math
+import copy
+import queue
 import logging
+import functools
+import signal
+import uuid
+import tempfile
+import subprocess
 from datetime import datetime, timedelta
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, request, abort
-from threading import Thread
+from werkzeug.serving import make_server
+import threading
+from threading import Thread, Event
+from collections import deque, OrderedDict, Counter
 import asyncio  # asyncio is still needed for run_polling and other async ops
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, DeleteOne, UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure, PyMongoError, DuplicateKeyError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
+    BaseUpdateProcessor,
     ContextTypes,
     CallbackContext
 )
 import requests
-from telegram.error import TelegramError
+from requests.adapters import HTTPAdapter
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest
+from telegram.request import HTTPXRequest
+from bson import BSON
 from bson.objectid import ObjectId
 
 # Initialize Flask app for health check
 app = Flask(__name__)
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Logging
+# setup_logging() routes every record through a queue to a listener thread, so
+# the event loop never blocks on log I/O. Records are not formatted before they
+# are queued: %-style arguments are only interpolated on the listener thread.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' or 'text'
+# Comma-separated "logger=rate" pairs; INFO and lower records of these loggers are kept with that probability
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'earnbot.updates=0.1,httpx=0.1')
+
 logger = logging.getLogger(__name__)
+update_logger = logging.getLogger('earnbot.updates')  # one line per handled update
+log_context = ContextVar('log_context', default={})  # update_id/user_id/handler of the update being handled
+_log_listener = None
+
+class JsonFormatter(logging.Formatter):
+    CONTEXT_FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ContextQueueHandler(QueueHandler):
+    """Queues records unformatted, tagged with the log context of the current update."""
+
+    def prepare(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return record
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a share of a logger's INFO and lower records; warnings always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.INFO or random.random() < self.rate
+
+def setup_logging():
+    global _log_listener
+    if _log_listener is not None:
+        return
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.handlers = [ContextQueueHandler(log_queue)]
+    root_logger.setLevel(LOG_LEVEL)
+    for entry in LOG_SAMPLE_RATES.split(','):
+        if '=' in entry:
+            name, rate = entry.split('=', 1)
+            logging.getLogger(name.strip()).addFilter(SamplingFilter(float(rate)))
+
+    _log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+
+def stop_logging():
+    """Writes out any queued records and stops the listener thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def _update_context(update, handler):
+    user = update.effective_user if isinstance(update, Update) else None
+    return {
+        "update_id": getattr(update, 'update_id', None),
+        "user_id": user.id if user else None,
+        "handler": handler,
+    }
+
+def with_log_context(callback):
+    """Tags log records with the update (or job) context for callbacks not wrapped by instrument().
+
+    Used for the error handler and job callbacks. Job callbacks take only
+    ``context``; their records carry the job's name as the handler.
+    """
+    @functools.wraps(callback)
+    async def wrapper(*args):
+        update = args[0] if len(args) == 2 else None
+        token = log_context.set(_update_context(update, callback.__name__))
+        try:
+            return await callback(*args)
+        finally:
+            log_context.reset(token)
+    return wrapper
+
+def instrument(callback):
+    """Wraps a handler so its log records carry the update's context and its duration is logged.
+
+    While slow-update capture is on, time spent in MongoDB, the Telegram API
+    and the shortener is also collected and slow updates are kept in
+    slow_updates.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        global inflight_updates
+        context_info = _update_context(update, callback.__name__)
+        token = log_context.set(context_info)
+        phases = {} if slow_updates.enabled else None
+        phases_token = update_phases.set(phases)
+        started = time.perf_counter()
+        inflight_updates += 1
+        try:
+            return await callback(update, context)
+        finally:
+            inflight_updates -= 1
+            duration = time.perf_counter() - started
+            update_logger.info("Handled update", extra={"duration_ms": round(duration * 1000, 1)})
+            if phases is not None:
+                slow_updates.record(duration, context_info, phases)
+            update_phases.reset(phases_token)
+            log_context.reset(token)
+    return wrapper
+
+
+# Profiling
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 0.5))  # seconds; slower updates are kept
+SLOW_UPDATE_BUFFER_SIZE = 20
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_SECONDS = 300
+
+# Per-phase seconds for the update being handled; None when capture is off
+update_phases = ContextVar('update_phases', default=None)
+
+def record_phase(phase, seconds):
+    phases = update_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+class SlowUpdates:
+    """Ring buffer of the most recent updates slower than SLOW_UPDATE_THRESHOLD."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.entries = deque(maxlen=SLOW_UPDATE_BUFFER_SIZE)
+
+    def record(self, duration, context_info, phases):
+        if duration >= SLOW_UPDATE_THRESHOLD:
+            self.entries.append(dict(context_info, duration=duration, phases=dict(phases), at=datetime.utcnow()))
+
+    def slowest(self):
+        return sorted(self.entries, key=lambda entry: entry['duration'], reverse=True)
+
+slow_updates = SlowUpdates(enabled=os.getenv('SLOW_UPDATE_CAPTURE', '1') == '1')
+
+class MongoPhaseListener(monitoring.CommandListener):
+    """Adds the duration of every MongoDB command to the current update's 'db' phase."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_phase('db', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_phase('db', event.duration_micros / 1e6)
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest that adds Bot API call durations to the current update's 'telegram' phase."""
+
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            record_phase('telegram', time.perf_counter() - started)
+
+class SamplingProfiler:
+    """Samples one thread's Python stack at a fixed interval from a helper thread.
+
+    Produces collapsed stacks ("outer;inner;leaf count" lines) that
+    flamegraph.pl or speedscope render as a flamegraph. Nothing runs in the
+    profiled thread itself.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+
+    def run(self, seconds, stop_event=None):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not (stop_event and stop_event.is_set()):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return self.samples
+
+    def write_collapsed(self, file_obj):
+        for stack, count in self.samples.most_common():
+            file_obj.write(f"{stack} {count}\n")
 
 # Configuration
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-if not TOKEN:
-    raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set!")
+TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')  # checked in build_application() so the module imports without it
 
 MONGO_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
-client = MongoClient(MONGO_URI)
-db = client.get_database('earnbot')
-users = db.users
-user_states = db.user_states
-withdrawal_requests = db.withdrawal_requests
+_client = None
+
+def get_client():
+    """Returns the shared MongoClient, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = MongoClient(MONGO_URI, event_listeners=[MongoPhaseListener()])
+    return _client
+
+def get_db():
+    return get_client().get_database('earnbot')
+
+class LazyCollection:
+    """Stands in for a pymongo collection and resolves it on first attribute access.
+
+    Lets the module keep its collection globals without importing opening a
+    connection to MongoDB.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._collection = None
+
+    def __getattr__(self, attr):
+        if self._collection is None:
+            self._collection = get_db()[self.name]
+        return getattr(self._collection, attr)
+
+users = LazyCollection('users')
+user_states = LazyCollection('user_states')
+withdrawal_requests = LazyCollection('withdrawal_requests')
+ptb_persistence = LazyCollection('ptb_persistence')
+schema_meta = LazyCollection('schema_meta')
+settings_collection = LazyCollection('settings')
+notification_outbox = LazyCollection('notification_outbox')
+withdrawal_archive = LazyCollection('withdrawal_archive')
+withdrawal_totals = LazyCollection('withdrawal_totals')
+broadcast_jobs = LazyCollection('broadcast_jobs')
 
 # --- Admin ID ---
 ADMIN_ID = 7315805581  # Replace with your actual Telegram User ID
 # --- Admin ID ---
 
-# Bot constants
-MIN_WITHDRAWAL = 70
-EARN_PER_LINK = 0.15
-REFERRAL_BONUS = 0.50
-LINK_COOLDOWN = 1  # minutes
+# Economics settings defaults. Live values are stored in the settings collection,
+# changed from /admin and read through get_setting().
+SETTINGS_DEFAULTS = {
+    'min_withdrawal': 70.0,
+    'earn_per_link': 0.15,
+    'referral_bonus': 0.50,
+    'link_cooldown': 1.0,  # minutes
+    'api_token': os.getenv('SHORTS_API_TOKEN', '4ca8f20ebd8b02f6fe1f55eb1e49136f69e2f5a0'),  # SmallShorts API Token
+}
+SETTING_LABELS = {
+    'min_withdrawal': "Minimum Withdrawal (₹)",
+    'earn_per_link': "Earning per Link (₹)",
+    'referral_bonus': "Referral Bonus (₹)",
+    'link_cooldown': "Link Cooldown (minutes)",
+    'api_token': "Shortener API Token",
+}
+# Accepted range (inclusive) for the numeric settings
+SETTING_BOUNDS = {
+    'min_withdrawal': (1.0, 100000.0),
+    'earn_per_link': (0.0, 100.0),
+    'referral_bonus': (0.0, 10000.0),
+    'link_cooldown': (0.0, 1440.0),  # at most a day
+}
+SETTINGS_POLL_INTERVAL = int(os.getenv('SETTINGS_POLL_INTERVAL', 30))  # seconds, used when change streams are unavailable
+
+# Seconds between PTB persistence runs (dirty user/chat/bot data is written in one bulk_write per run)
+PERSISTENCE_UPDATE_INTERVAL = int(os.getenv('PERSISTENCE_UPDATE_INTERVAL', 30))
+PERSISTENCE_CACHE_SIZE = int(os.getenv('PERSISTENCE_CACHE_SIZE', 10000))  # entries whose stored copy is remembered
+
+# Notification outbox configuration
+OUTBOX_POLL_INTERVAL = 5  # seconds between notifier runs (new events also wake it immediately)
+OUTBOX_BATCH_SIZE = 20  # events claimed per notifier run
+OUTBOX_MAX_ATTEMPTS = 8  # failed sends are retried with exponential backoff up to this many times
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=5)  # events stuck in 'sending' longer than this are retried
+OUTBOX_RETENTION = timedelta(days=7)  # sent events are kept this long for deduplication
+
+# Duplicate update protection
+IDEMPOTENCY_CACHE_SIZE = 10000  # recent update/callback keys remembered
+DOUBLE_TAP_WINDOW = 2.0  # seconds in which a repeated tap on the same button is ignored
+
+# Flood throttling: (max updates, window seconds) per user. Keys are checked from
+# most to least specific: "command:<name>" then "command", "callback:<data>" then
+# "callback", and "message". THROTTLE_LIMITS="command:start=5/60,callback=20/60" overrides.
+THROTTLE_DEFAULT_LIMITS = {
+    'command:start': (5, 60),
+    'command': (10, 60),
+    'callback:generate_link': (3, 60),
+    'callback': (30, 60),
+    'message': (20, 60),
+}
+THROTTLE_SWEEP_INTERVAL = 60  # seconds between sweeps of idle (user, key) windows
+
+# Shutdown: on SIGTERM the bot stops polling and drains work for at most this many seconds
+SHUTDOWN_DEADLINE = float(os.getenv('SHUTDOWN_DEADLINE', 25))
+BROADCAST_CHECKPOINT_EVERY = 50  # broadcast progress is saved after this many recipients
+BROADCAST_HEARTBEAT = 30  # seconds; progress is also saved this often, renewing the lease
+BROADCAST_LEASE = timedelta(minutes=2)  # a running broadcast not renewed for this long may be taken over
+BROADCAST_OWNER = uuid.uuid4().hex  # identifies this process in broadcast leases; new on every start
+
+# Withdrawal archival: completed requests older than this move to withdrawal_archive
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_COMPRESSOR = os.getenv('ARCHIVE_COMPRESSOR', 'zstd')  # WiredTiger block compressor for the archive
+# The old zero-balance user purge (cleanup_old_data) also hits recently paid users; archival replaces it
+USER_CLEANUP_ENABLED = os.getenv('USER_CLEANUP_ENABLED', '0') == '1'
+
+# Payout export configuration
+EXPORT_BATCH_SIZE = 500  # withdrawal requests fetched (and users joined) per round trip
+EXPORT_FORMATS = ('csv', 'upi', 'bank')
 
 # Shortlink API configuration
-API_TOKEN = '4ca8f20ebd8b02f6fe1f55eb1e49136f69e2f5a0'  # Replace with your SmallShorts API Token
-SHORTS_API_BASE_URL = "https://dashboard.smallshorts.com/api"
+# Comma-separated "name|base_url|api_token" entries. Every provider must speak the
+# AdLinkFly-style API SmallShorts uses; an empty token falls back to the api_token setting.
+SHORTENER_PROVIDERS = os.getenv('SHORTENER_PROVIDERS', 'smallshorts|https://dashboard.smallshorts.com/api|')
+SHORTENER_TIMEOUT = float(os.getenv('SHORTENER_TIMEOUT', 10))  # seconds per provider request
+SHORTENER_HEDGE = os.getenv('SHORTENER_HEDGE', '0') == '1'  # fire a second provider after the first one's p95
+SHORTENER_HEDGE_DEFAULT_DELAY = 1.0  # seconds, used until a provider has enough latency samples
+SHORTENER_STATS_WINDOW = 100  # recent requests kept per provider for latency/error stats
+SHORTENER_MAX_ERROR_RATE = 0.5  # providers failing more often than this sit out a cooldown
+SHORTENER_MIN_SAMPLES = 10  # requests needed before the error rate is judged
+SHORTENER_FAILURE_COOLDOWN = 60  # seconds a provider sits out after 3 failures in a row or a high error rate
+SHORTENER_EXPLORE_RATE = 0.05  # share of requests sent to a random healthy provider to refresh its stats
+SHORTENER_MAX_WORKERS = int(os.getenv('SHORTENER_MAX_WORKERS', 16))  # threads (and pooled connections) for shortener calls
 
 # Webhook configuration (REMOVE THESE FOR POLLING)
 # WEBHOOK_PATH = f"/telegram-webhook/{TOKEN}"
 # WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
 # Database setup functions
-def init_user_state_db():
-    """Initializes the user_states collection."""
-    user_states.create_index("user_id", unique=True)
-
-def init_withdrawal_requests_db():
-    """Initializes the withdrawal_requests collection."""
-    withdrawal_requests.create_index("user_id")
-    withdrawal_requests.create_index("status")
-    withdrawal_requests.create_index("timestamp")
+# Bump INDEX_SCHEMA_VERSION whenever INDEX_SPECS changes; init_db() only talks
+# to the server about indexes when the stored version differs.
+INDEX_SCHEMA_VERSION = 4
+INDEX_SPECS = {
+    'users': [
+        ([("user_id", 1)], {"unique": True}),
+        ([("referral_code", 1)], {"unique": True, "sparse": True}),
+    ],
+    'user_states': [
+        ([("user_id", 1)], {"unique": True}),
+    ],
+    'withdrawal_requests': [
+        ([("user_id", 1)], {}),
+        ([("status", 1)], {}),
+        ([("timestamp", 1)], {}),
+        # At most one pending request per user
+        ([("user_id", 1), ("status", 1)], {"name": "user_id_pending_unique", "unique": True,
+                                           "partialFilterExpression": {"status": "pending"}}),
+        ([("status", 1), ("completed_at", 1)], {}),
+    ],
+    'withdrawal_archive': [
+        ([("user_id", 1)], {}),
+        ([("timestamp", 1)], {}),
+    ],
+    'withdrawal_totals': [
+        ([("user_id", 1)], {"unique": True}),
+    ],
+    'notification_outbox': [
+        ([("dedupe_key", 1)], {"unique": True}),
+        ([("status", 1), ("next_attempt_at", 1)], {}),
+        ([("sent_at", 1)], {"expireAfterSeconds": int(OUTBOX_RETENTION.total_seconds())}),
+    ],
+}
+
+def _index_name(keys, options):
+    return options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+
+# Unique indexes init_db() could not build because existing documents
+# violate them: index name -> sample of duplicate groups ({"_id": key, "ids": [...]})
+index_conflicts = {}
+
+def _find_duplicates(collection, keys, options, limit=20):
+    """Returns up to limit groups of documents that would violate a unique index."""
+    pipeline = [
+        {"$match": options.get("partialFilterExpression", {})},
+        {"$group": {
+            "_id": {field: f"${field}" for field, _ in keys},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit}
+    ]
+    return list(collection.aggregate(pipeline, allowDiskUse=True))
 
 def init_db():
-    """Initializes all necessary database collections and indexes."""
-    users.create_index("user_id", unique=True)
-    users.create_index("referral_code", unique=True, sparse=True)
-    init_user_state_db()
-    init_withdrawal_requests_db()
-init_db()
+    """Reconciles indexes with INDEX_SPECS if the index schema version changed.
+
+    Returns True if indexes were checked against the server, False if the
+    stored version was already current. Unique indexes that existing data
+    violates are left out and listed in index_conflicts.
+    """
+    stored = schema_meta.find_one({"_id": "indexes"})
+    if stored and stored.get("version") == INDEX_SCHEMA_VERSION:
+        return False
+
+    index_conflicts.clear()
+    complete = True
+    database = get_db()
+    if 'withdrawal_archive' not in database.list_collection_names():
+        # Compression can only be chosen when the collection is created
+        try:
+            database.create_collection(
+                'withdrawal_archive',
+                storageEngine={'wiredTiger': {'configString': f'block_compressor={ARCHIVE_COMPRESSOR}'}}
+            )
+        except OperationFailure as e:
+            logger.warning("Could not create compressed withdrawal_archive, using defaults: %s", e)
+
+    for collection_name, specs in INDEX_SPECS.items():
+        collection = get_db()[collection_name]
+        existing = {index["name"] for index in collection.list_indexes()}
+        for keys, options in specs:
+            name = _index_name(keys, options)
+            if name in existing:
+                continue
+            if options.get("unique"):
+                duplicates = _find_duplicates(collection, keys, options)
+                if duplicates:
+                    complete = False
+                    index_conflicts[name] = duplicates
+                    logger.error("Not creating unique index %s on %s: %s+ groups of duplicates, e.g. %s",
+                                 name, collection_name, len(duplicates), duplicates[0]["ids"])
+                    continue
+            try:
+                collection.create_index(keys, name=name, **options)
+                logger.info("Created index %s on %s.", name, collection_name)
+            except OperationFailure as e:
+                complete = False
+                logger.error("Failed to create index %s on %s: %s", name, collection_name, e)
+
+    # Leave the version untouched after a failure so the next start retries
+    if complete:
+        schema_meta.update_one(
+            {"_id": "indexes"},
+            {"$set": {"version": INDEX_SCHEMA_VERSION, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    return True
+
+_transactions_supported = None
+
+def run_in_transaction(callback):
+    """Runs callback(session) inside a transaction.
+
+    Standalone MongoDB servers cannot run transactions; there the callback is
+    run once with session=None instead.
+    """
+    global _transactions_supported
+    if _transactions_supported is not False:
+        try:
+            with get_client().start_session() as session:
+                result = session.with_transaction(callback)
+            _transactions_supported = True
+            return result
+        except OperationFailure as e:
+            # IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+            if _transactions_supported or e.code != 20:
+                raise
+            _transactions_supported = False
+            logger.warning("MongoDB does not support transactions; writing outbox events without one.")
+    return callback(None)
+
+
+class MongoPersistence(BasePersistence):
+    """Stores PTB user/bot data in ``ptb_persistence``, loading users lazily and batching writes."""
+
+    def __init__(self, collection, update_interval=PERSISTENCE_UPDATE_INTERVAL,
+                 cache_size=PERSISTENCE_CACHE_SIZE):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.collection = collection
+        self.cache_size = cache_size
+        self._stored = OrderedDict()  # doc_id -> data as last loaded/written
+        self._conversations = {}
+        self._dirty = {}
+        self._flush_task = None
+
+    # --- Loading ---
+    def _load(self, doc_id):
+        doc = self.collection.find_one({"_id": doc_id}, {"data": 1})
+        return doc.get("data") if doc else None
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return await asyncio.to_thread(self._load, "bot_data") or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        if name not in self._conversations:
+            stored = await asyncio.to_thread(self._load, f"conversations:{name}") or []
+            self._conversations[name] = {tuple(entry["key"]): entry["state"] for entry in stored}
+        return dict(self._conversations[name])
+
+    def _remember(self, doc_id, data):
+        self._stored[doc_id] = copy.deepcopy(data)
+        self._stored.move_to_end(doc_id)
+        while len(self._stored) > self.cache_size:
+            self._stored.popitem(last=False)
+
+    async def _refresh(self, doc_id, data):
+        if doc_id in self._stored:
+            self._stored.move_to_end(doc_id)
+            return
+        stored = await asyncio.to_thread(self._load, doc_id)
+        if stored:
+            # Entries set before the lazy load (if any) win over stored values
+            for key, value in stored.items():
+                data.setdefault(key, value)
+        self._remember(doc_id, stored or {})
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(f"user_data:{user_id}", user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(f"chat_data:{chat_id}", chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Write coalescing ---
+    def _mark_dirty(self, doc_id, data):
+        data = copy.deepcopy(data) if data else None
+        if doc_id not in self._dirty and doc_id in self._stored and (self._stored[doc_id] or None) == data:
+            return  # unchanged since it was last loaded or written
+        self._dirty[doc_id] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_dirty())
+
+    async def _flush_dirty(self):
+        # PTB gathers all update_* calls of one persistence run together; yield
+        # once so every one of them has marked its entry before we write.
+        await asyncio.sleep(0)
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        ops = [
+            ReplaceOne({"_id": doc_id}, {"_id": doc_id, "data": data}, upsert=True) if data
+            else DeleteOne({"_id": doc_id})
+            for doc_id, data in pending.items()
+        ]
+        try:
+            await asyncio.to_thread(self.collection.bulk_write, ops, ordered=False)
+        except Exception as e:
+            logger.error("Failed to flush %s persistence entries: %s", len(pending), e)
+            # Put failed entries back unless they were re-dirtied meanwhile
+            for doc_id, data in pending.items():
+                self._dirty.setdefault(doc_id, data)
+            return
+        for doc_id, data in pending.items():
+            self._remember(doc_id, data or {})
+
+    async def update_user_data(self, user_id, data):
+        self._mark_dirty(f"user_data:{user_id}", dict(data))
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark_dirty(f"chat_data:{chat_id}", dict(data))
+
+    async def update_bot_data(self, data):
+        self._mark_dirty("bot_data", dict(data))
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._mark_dirty(
+            f"conversations:{name}",
+            [{"key": list(k), "state": state} for k, state in conversations.items()]
+        )
+
+    async def drop_user_data(self, user_id):
+        self._mark_dirty(f"user_data:{user_id}", None)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark_dirty(f"chat_data:{chat_id}", None)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+
+
+# Settings
+# The handlers read settings from _settings_cache only. The cache is replaced
+# wholesale by load_settings(), which the watcher thread calls whenever the
+# settings document changes, so a read never waits on MongoDB after the first.
+_settings_cache = None
+settings_stop_event = Event()
+
+# Lifecycle flags, also read from the Flask and worker threads
+ready = Event()  # set once startup finished; cleared first on shutdown
+shutdown_requested = Event()  # long-running loops checkpoint and stop when set
+inflight_updates = 0  # handlers currently running, maintained by instrument()
+
+def load_settings():
+    """Reloads the settings document into the in-process cache and returns it."""
+    global _settings_cache
+    stored = settings_collection.find_one({"_id": "economics"}) or {}
+    settings = dict(SETTINGS_DEFAULTS)
+    settings.update({key: value for key, value in stored.items() if key in SETTINGS_DEFAULTS})
+    _settings_cache = settings
+    return settings
+
+def get_setting(name):
+    settings = _settings_cache
+    if settings is None:
+        settings = load_settings()
+    return settings[name]
+
+def set_setting(name, value):
+    """Stores a new value; other processes pick it up through watch_settings()."""
+    settings_collection.update_one(
+        {"_id": "economics"},
+        {"$set": {name: value, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    load_settings()
+
+def parse_setting_value(name, text):
+    """Converts admin input for a setting, raising ValueError if it is not acceptable."""
+    if name == 'api_token':
+        value = text.strip()
+        if not value:
+            raise ValueError("API token cannot be empty.")
+        return value
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError("Value must be a finite number.")
+    low, high = SETTING_BOUNDS[name]
+    if not low <= value <= high:
+        raise ValueError(f"Value must be between {low:g} and {high:g}.")
+    return value + 0.0  # turns -0.0 into 0.0
+
+def _poll_settings():
+    while not settings_stop_event.wait(SETTINGS_POLL_INTERVAL):
+        try:
+            load_settings()
+        except PyMongoError as e:
+            logger.warning("Failed to poll settings: %s", e)
+
+def watch_settings():
+    """Keeps the settings cache fresh; runs in a daemon thread.
+
+    Uses a change stream on the settings collection and falls back to polling
+    every SETTINGS_POLL_INTERVAL seconds when change streams are unsupported
+    (e.g. a standalone mongod).
+    """
+    pipeline = [{"$match": {"documentKey._id": "economics"}}]
+    while not settings_stop_event.is_set():
+        try:
+            with settings_collection.watch(pipeline, max_await_time_ms=1000) as stream:
+                # Catch up on anything that changed before the stream was opened
+                load_settings()
+                while not settings_stop_event.is_set() and stream.alive:
+                    if stream.try_next() is not None:
+                        load_settings()
+        except OperationFailure as e:
+            logger.info("Settings change stream unavailable (%s); polling every %ss instead.", e, SETTINGS_POLL_INTERVAL)
+            _poll_settings()
+            return
+        except PyMongoError as e:
+            logger.warning("Settings change stream interrupted: %s", e)
+            settings_stop_event.wait(SETTINGS_POLL_INTERVAL)
+
+
+# Idempotency
+class RecentKeys:
+    """Bounded LRU of recently seen keys with the time each was last seen."""
+
+    def __init__(self, maxsize=IDEMPOTENCY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def seen(self, key, window=None):
+        """Records key and returns True if it was already recorded (within window seconds, if given)."""
+        now = time.monotonic()
+        last_seen = self._keys.pop(key, None)
+        self._keys[key] = now
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+        return last_seen is not None and (window is None or now - last_seen < window)
+
+recent_updates = RecentKeys()
+
+async def drop_duplicate_updates(update: Update):
+    """Returns True (answering the button) for redelivered updates and double-tapped buttons."""
+    duplicate = recent_updates.seen(f"update:{update.update_id}")
+    query = update.callback_query
+    if query and not duplicate:
+        duplicate = recent_updates.seen(f"callback:{query.id}")
+        if not duplicate and query.message:
+            duplicate = recent_updates.seen(
+                f"tap:{query.from_user.id}:{query.message.message_id}:{query.data}",
+                window=DOUBLE_TAP_WINDOW
+            )
+    if duplicate:
+        logger.info("Ignoring duplicate update %s.", update.update_id)
+        if query:
+            # Stop the button's loading spinner; the first tap already got the real reply
+            try:
+                await query.answer()
+            except TelegramError:
+                pass
+    return duplicate
+
+# Throttling
+def parse_throttle_limits(spec):
+    limits = dict(THROTTLE_DEFAULT_LIMITS)
+    for entry in spec.split(','):
+        if '=' not in entry:
+            continue
+        key, limit = entry.split('=', 1)
+        try:
+            count, window = limit.split('/', 1)
+            count, window = int(count), float(window)
+            if count < 1 or not 0 < window < float('inf'):
+                raise ValueError("count and window must be positive")
+        except ValueError as e:
+            logger.warning("Ignoring malformed THROTTLE_LIMITS entry %r: %s", entry.strip(), e)
+            continue
+        limits[key.strip()] = (count, window)
+    return limits
+
+class SlidingWindowThrottle:
+    """In-memory sliding-window rate limiter keyed by (user_id, key)."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._hits = {}
+        self._warned = {}
+        self._lock = threading.Lock()
+        self.dropped = Counter()  # per limit key; read by /metrics from the Flask thread
+        self.soft_replies = 0
+        self._next_sweep = time.monotonic() + THROTTLE_SWEEP_INTERVAL
+
+    def check(self, user_id, keys):
+        """Records a hit and returns the first exceeded limit key, or None if the update may pass."""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+            self._next_sweep = now + THROTTLE_SWEEP_INTERVAL
+
+        windows = []
+        for key in keys:
+            if key not in self.limits:
+                continue
+            limit, window = self.limits[key]
+            hits = self._hits.setdefault((user_id, key), deque())
+            while hits and now - hits[0] >= window:
+                hits.popleft()
+            if len(hits) >= limit:
+                with self._lock:
+                    self.dropped[key] += 1
+                return key
+            windows.append(hits)
+
+        # Dropped updates do not count towards the limits
+        for hits in windows:
+            hits.append(now)
+        return None
+
+    def should_warn(self, user_id, key):
+        """True once per window for a throttled user, so only the first drop gets a reply."""
+        now = time.monotonic()
+        window = self.limits[key][1]
+        if now - self._warned.get((user_id, key), float('-inf')) < window:
+            return False
+        self._warned[(user_id, key)] = now
+        with self._lock:
+            self.soft_replies += 1
+        return True
+
+    def _sweep(self, now):
+        longest = max(window for _, window in self.limits.values())
+        self._hits = {k: hits for k, hits in self._hits.items() if hits and now - hits[-1] < longest}
+        self._warned = {k: at for k, at in self._warned.items() if now - at < longest}
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.dropped), self.soft_replies
+
+throttle = SlidingWindowThrottle(parse_throttle_limits(os.getenv('THROTTLE_LIMITS', '')))
+
+def throttle_keys(update: Update):
+    if update.callback_query:
+        return [f"callback:{update.callback_query.data}", "callback"]
+    message = update.effective_message
+    if message and message.text and message.text.startswith('/'):
+        command = message.text.split()[0][1:].split('@')[0].lower()
+        return [f"command:{command}", "command"]
+    return ["message"]
+
+async def throttle_updates(update: Update):
+    """Returns True (sending the throttle notice, if due) for updates from users over their limits."""
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return False
+    exceeded = throttle.check(user.id, throttle_keys(update))
+    if not exceeded:
+        return False
+
+    logger.info("Throttled user %s on %s.", user.id, exceeded)
+    warn = throttle.should_warn(user.id, exceeded)
+    try:
+        if update.callback_query:
+            # Always answer so the button stops spinning; only the first drop gets text
+            await update.callback_query.answer("⏳ Too many requests. Please slow down." if warn else None)
+        elif warn and update.effective_message:
+            await update.effective_message.reply_text("⏳ Too many requests. Please wait a minute and try again.")
+    except TelegramError as e:
+        logger.warning("Failed to send throttle notice to user %s: %s", user.id, e)
+    return True
+
+class GuardedUpdateProcessor(BaseUpdateProcessor):
+    """Drops duplicate and throttled updates before PTB builds their context.
+
+    Building the context loads the user's persisted data, so checking here
+    keeps floods and redeliveries from costing any MongoDB reads.
+    """
+
+    async def do_process_update(self, update, coroutine):
+        dropped = False
+        if isinstance(update, Update):
+            token = log_context.set(_update_context(update, 'update_guard'))
+            try:
+                dropped = await drop_duplicate_updates(update) or await throttle_updates(update)
+            except Exception as e:
+                # Never lose an update to a failing guard
+                logger.error("Update guard failed for update %s: %s", update.update_id, e)
+            finally:
+                log_context.reset(token)
+        if dropped:
+            coroutine.close()
+        else:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def has_pending_withdrawal(user_id):
+    return withdrawal_requests.find_one({"user_id": user_id, "status": "pending"}, {"_id": 1}) is not None
+
 
 # Helper functions
+def welcome_text():
+    return (
+        "🎉 Welcome to Earn Bot!\n"
+        f"Solve links and earn ₹{get_setting('earn_per_link'):g} per link!\n"
+        f"Minimum withdrawal: ₹{get_setting('min_withdrawal'):g}"
+    )
+
 def get_user(user_id):
     user = users.find_one({"user_id": user_id})
     if not user:
@@ -110,31 +970,186 @@ def set_user_state(user_id, state_name):
 def clear_user_state(user_id):
     user_states.delete_one({"user_id": user_id})
 
-def generate_short_link(long_url):
-    try:
+def _p95(latencies):
+    if len(latencies) < 20:
+        return None
+    ordered = sorted(latencies)
+    return ordered[int(len(ordered) * 0.95) - 1]
+
+
+# Shortener calls get their own threads and connection pool, so slow providers
+# and hedge losers cannot tie up the default executor the rest of the bot uses
+shortener_executor = ThreadPoolExecutor(max_workers=SHORTENER_MAX_WORKERS, thread_name_prefix='shortener')
+shortener_session = requests.Session()
+shortener_session.mount('https://', HTTPAdapter(pool_maxsize=SHORTENER_MAX_WORKERS))
+shortener_session.mount('http://', HTTPAdapter(pool_maxsize=SHORTENER_MAX_WORKERS))
+
+def run_shortener_call(func, *args):
+    """Like asyncio.to_thread, but on shortener_executor."""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(shortener_executor, functools.partial(copy_context().run, func, *args))
+
+
+class ShortenerProvider:
+    """One link shortener backend plus its recent latency and error history."""
+
+    def __init__(self, name, base_url, api_token=None):
+        self.name = name
+        self.base_url = base_url
+        self.api_token = api_token
+        self.latencies = deque(maxlen=SHORTENER_STATS_WINDOW)
+        self.outcomes = deque(maxlen=SHORTENER_STATS_WINDOW)
+        self.consecutive_failures = 0
+        self.disabled_until = 0.0
+
+    def _request(self, long_url):
         params = {
-            'api': API_TOKEN,
+            'api': self.api_token or get_setting('api_token'),
             'url': long_url
         }
-        response = requests.get(SHORTS_API_BASE_URL, params=params)
+        response = shortener_session.get(self.base_url, params=params, timeout=SHORTENER_TIMEOUT)
         response.raise_for_status()
-        result = response.json()
+        return response.json()
 
-        if result.get('status') == 'error':
-            logger.error(f"SmallShorts API Error: {result.get('message')}")
-            return None
-        elif result.get('shortenedUrl'):
-            return result['shortenedUrl']
+    def shorten(self, long_url):
+        """Returns the short URL or None; blocking, so run it in a thread."""
+        started = time.monotonic()
+        short_url = None
+        try:
+            result = self._request(long_url)
+            if result.get('status') == 'error':
+                logger.error("%s API Error: %s", self.name, result.get('message'))
+            elif result.get('shortenedUrl'):
+                short_url = result['shortenedUrl']
+            else:
+                logger.error("Unexpected %s API response: %s", self.name, result)
+        except requests.exceptions.RequestException as e:
+            logger.error("Error connecting to %s API: %s", self.name, e)
+        except ValueError as e:
+            logger.error("Error parsing %s API response (not JSON): %s", self.name, e)
+        self.record(time.monotonic() - started, short_url is not None)
+        return short_url
+
+    def record(self, latency, ok):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
         else:
-            logger.error(f"Unexpected SmallShorts API response: {result}")
-            return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error connecting to SmallShorts API: {e}")
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= 3:
+                self.disabled_until = time.monotonic() + SHORTENER_FAILURE_COOLDOWN
+            elif len(self.outcomes) >= SHORTENER_MIN_SAMPLES and self.error_rate > SHORTENER_MAX_ERROR_RATE:
+                # Sit out a cooldown, then come back on probation with a fresh
+                # error history instead of being judged on stale failures forever
+                self.disabled_until = time.monotonic() + SHORTENER_FAILURE_COOLDOWN
+                self.outcomes.clear()
+
+    @property
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def median_latency(self):
+        """Typical latency in seconds; unlike a mean it ignores the odd spike. 0 if unmeasured."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2]
+
+    def p95(self):
+        """95th percentile latency in seconds, or None with fewer than 20 samples."""
+        return _p95(self.latencies)
+
+    def is_healthy(self):
+        return time.monotonic() >= self.disabled_until
+
+
+class ShortenerPool:
+    """Routes each request to the fastest healthy provider.
+
+    Providers without samples yet sort first so they get measured, and a
+    small share of requests goes to a random provider so a slow reading
+    does not stick forever. With
+    hedging on, a second provider is fired once the first has been running
+    longer than its own p95 latency and whichever answers first wins.
+    """
+
+    def __init__(self, providers, hedge=SHORTENER_HEDGE):
+        self.providers = providers
+        self.hedge = hedge
+
+    def ranked(self):
+        healthy = [p for p in self.providers if p.is_healthy()]
+        if not healthy:
+            # Everything is failing; try whichever comes back from cooldown first
+            return sorted(self.providers, key=lambda p: p.disabled_until)
+        ranked = sorted(healthy, key=lambda p: p.median_latency())
+        if len(ranked) > 1 and random.random() < SHORTENER_EXPLORE_RATE:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    async def shorten(self, long_url):
+        candidates = self.ranked()
+        if self.hedge and len(candidates) > 1:
+            short_url = await self._hedged(candidates[0], candidates[1], long_url)
+            candidates = candidates[2:]
+            if short_url:
+                return short_url
+        for provider in candidates:
+            short_url = await run_shortener_call(provider.shorten, long_url)
+            if short_url:
+                return short_url
         return None
-    except ValueError as e:
-        logger.error(f"Error parsing SmallShorts API response (not JSON): {e}")
+
+    def hedge_delay(self, provider):
+        """The provider's own p95, else the pool-wide p95, else the configured default."""
+        delay = provider.p95()
+        if delay is None:
+            delay = _p95([latency for p in self.providers for latency in p.latencies])
+        return delay if delay is not None else SHORTENER_HEDGE_DEFAULT_DELAY
+
+    async def _hedged(self, primary, secondary, long_url):
+        first = asyncio.ensure_future(run_shortener_call(primary.shorten, long_url))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(primary))
+        if first in done and first.result():
+            return first.result()
+
+        pending = {asyncio.ensure_future(run_shortener_call(secondary.shorten, long_url))}
+        if first not in done:
+            pending.add(first)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result():
+                    # The slower request keeps running on shortener_executor only to feed the stats
+                    return task.result()
         return None
 
+
+_shortener_pool = None
+
+def parse_shortener_providers(spec):
+    providers = []
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, base_url, api_token = (entry.split('|') + ['', ''])[:3]
+        providers.append(ShortenerProvider(name.strip(), base_url.strip(), api_token.strip() or None))
+    return providers
+
+def get_shortener_pool():
+    global _shortener_pool
+    if _shortener_pool is None:
+        _shortener_pool = ShortenerPool(parse_shortener_providers(SHORTENER_PROVIDERS))
+    return _shortener_pool
+
+async def generate_short_link(long_url):
+    started = time.perf_counter()
+    try:
+        return await get_shortener_pool().shorten(long_url)
+    finally:
+        record_phase('shortener', time.perf_counter() - started)
+
 # Bot handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -149,18 +1164,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             referrer_id = int(arg.split('_')[1])
             referrer = get_user(referrer_id)
             if referrer and referrer['user_id'] != user_id and user['referred_by'] is None:
+                referral_bonus = get_setting('referral_bonus')
                 users.update_one(
                     {"user_id": referrer_id},
                     {"$inc": {
                         "referrals": 1,
-                        "referral_earnings": REFERRAL_BONUS,
-                        "balance": REFERRAL_BONUS,
-                        "total_earned": REFERRAL_BONUS
+                        "referral_earnings": referral_bonus,
+                        "balance": referral_bonus,
+                        "total_earned": referral_bonus
                     }}
                 )
                 users.update_one({"user_id": user_id}, {"$set": {"referred_by": referrer_id}})
                 await update.message.reply_text(
-                    f"🎉 Welcome! You were referred by {referrer_id}! A bonus of ₹{REFERRAL_BONUS:.2f} has been added to their account."
+                    f"🎉 Welcome! You were referred by {referrer_id}! A bonus of ₹{referral_bonus:.2f} has been added to their account."
                 )
             elif referrer and referrer['user_id'] == user_id:
                 await update.message.reply_text("You cannot refer yourself.")
@@ -172,25 +1188,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif arg.startswith('solve_'):
             solved_user_id = int(arg.split('_')[1])
             if solved_user_id == user_id:
-                if user['last_click'] and (datetime.utcnow() - user['last_click']) < timedelta(minutes=LINK_COOLDOWN):
-                    remaining = (user['last_click'] + timedelta(minutes=LINK_COOLDOWN)) - datetime.utcnow()
+                cooldown = timedelta(minutes=get_setting('link_cooldown'))
+                if user['last_click'] and (datetime.utcnow() - user['last_click']) < cooldown:
+                    remaining = (user['last_click'] + cooldown) - datetime.utcnow()
                     remaining_seconds = int(remaining.total_seconds())
                     await update.message.reply_text(
                         f"⏳ You've recently completed a link. Please wait {remaining_seconds} seconds before earning again."
                     )
                 else:
-                    new_balance = user['balance'] + EARN_PER_LINK
+                    earn_per_link = get_setting('earn_per_link')
+                    new_balance = user['balance'] + earn_per_link
                     users.update_one(
                         {"user_id": user_id},
                         {"$set": {
                             "balance": new_balance,
-                            "total_earned": user['total_earned'] + EARN_PER_LINK,
+                            "total_earned": user['total_earned'] + earn_per_link,
                             "last_click": datetime.utcnow()
                         }}
                     )
                     await update.message.reply_text(
                         f"✅ Link solved successfully!\n"
-                        f"💰 You earned ₹{EARN_PER_LINK:.2f}. Your new balance: ₹{new_balance:.2f}"
+                        f"💰 You earned ₹{earn_per_link:.2f}. Your new balance: ₹{new_balance:.2f}"
                     )
             else:
                 await update.message.reply_text("This link was not generated for you.")
@@ -202,9 +1220,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
 
     await update.message.reply_text(
-        "🎉 Welcome to Earn Bot!\n"
-        "Solve links and earn ₹0.15 per link!\n"
-        "Minimum withdrawal: ₹70",
+        welcome_text(),
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
@@ -221,14 +1237,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         clear_user_state(user_id)  # This might clear state prematurely if user clicks a button during a stateful process
 
     if query.data == 'generate_link':
-        if user['last_click'] and (datetime.utcnow() - user['last_click']) < timedelta(minutes=LINK_COOLDOWN):
-            remaining = (user['last_click'] + timedelta(minutes=LINK_COOLDOWN)) - datetime.utcnow()
+        link_cooldown = get_setting('link_cooldown')
+        cooldown = timedelta(minutes=link_cooldown)
+        if user['last_click'] and (datetime.utcnow() - user['last_click']) < cooldown:
+            remaining = (user['last_click'] + cooldown) - datetime.utcnow()
             remaining_seconds = int(remaining.total_seconds())
             await query.edit_message_text(f"⏳ Please wait {remaining_seconds} seconds before generating another link.")
             return
 
         destination_link = f"https://t.me/{bot_username}?start=solve_{user_id}"
-        short_link = generate_short_link(destination_link)
+        short_link = await generate_short_link(destination_link)
 
         if not short_link:
             await query.edit_message_text(
@@ -245,7 +1263,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(
             f"✅ Your link is ready! Please click the button below to solve it.\n\n"
             f"Once you complete the steps on the website, you'll be redirected back to me, and your balance will be updated automatically.\n"
-            f"⏳ Next link available in {LINK_COOLDOWN} minute(s) after successful completion.",
+            f"⏳ Next link available in {link_cooldown:g} minute(s) after successful completion.",
             reply_markup=keyboard_markup
         )
 
@@ -256,7 +1274,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📊 Total Earned: ₹{user['total_earned']:.2f}\n"
             f"💸 Withdrawn: ₹{user['withdrawn']:.2f}\n"
             f"👥 Referrals: {user['referrals']} (₹{user['referral_earnings']:.2f})\n\n"
-            f"💵 Minimum withdrawal: ₹{MIN_WITHDRAWAL}",
+            f"💵 Minimum withdrawal: ₹{get_setting('min_withdrawal'):g}",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("💵 Withdraw", callback_data='withdraw')],
                 [InlineKeyboardButton("🔙 Back", callback_data='back_to_main')]
@@ -268,7 +1286,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👥 Referral Program\n\n"
             f"🔗 Your referral link:\n"
             f"https://t.me/{bot_username}?start={user['referral_code']}\n\n"
-            f"💰 Earn ₹{REFERRAL_BONUS} for each friend who joins using your link!\n"
+            f"💰 Earn ₹{get_setting('referral_bonus'):g} for each friend who joins using your link!\n"
             f"👥 Total referrals: {user['referrals']}\n"
             f"💸 Earned from referrals: ₹{user['referral_earnings']:.2f}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back_to_main')]])
@@ -281,14 +1299,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("👥 Refer Friends", callback_data='referral')]
         ]
         await query.edit_message_text(
-            "🎉 Welcome to Earn Bot!\n"
-            "Solve links and earn ₹0.15 per link!\n"
-            "Minimum withdrawal: ₹70",
+            welcome_text(),
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
     elif query.data == 'withdraw':
-        if user['balance'] >= MIN_WITHDRAWAL:
+        min_withdrawal = get_setting('min_withdrawal')
+        if has_pending_withdrawal(user_id):
+            await query.edit_message_text(
+                "⏳ You already have a pending withdrawal request. Please wait for it to be processed.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back_to_main')]])
+            )
+        elif user['balance'] >= min_withdrawal:
             # Offer withdrawal options
             keyboard = [
                 [InlineKeyboardButton("💳 UPI ID", callback_data='withdraw_upi')],
@@ -302,7 +1324,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await query.edit_message_text(
-                f"❌ Your balance (₹{user['balance']:.2f}) is below the minimum withdrawal amount of ₹{MIN_WITHDRAWAL:.2f}.",
+                f"❌ Your balance (₹{user['balance']:.2f}) is below the minimum withdrawal amount of ₹{min_withdrawal:.2f}.",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back_to_main')]])
             )
 
@@ -357,6 +1379,22 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'admin_show_pending_withdrawals':
         if user_id == ADMIN_ID:
             await admin_show_withdrawals(update, context)
+    elif query.data == 'admin_slow_updates':
+        if user_id == ADMIN_ID:
+            await admin_show_slow_updates(update, context)
+    elif query.data == 'admin_settings':
+        if user_id == ADMIN_ID:
+            await admin_show_settings(update, context)
+    elif query.data.startswith('admin_set_'):
+        if user_id == ADMIN_ID:
+            setting_name = query.data[len('admin_set_'):]
+            if setting_name in SETTINGS_DEFAULTS:
+                context.user_data['setting_to_change'] = setting_name
+                set_user_state(user_id, 'SET_SETTING_VALUE')
+                await query.edit_message_text(
+                    f"Please send the new value for {SETTING_LABELS[setting_name]}.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Cancel", callback_data='admin_settings')]])
+                )
     elif query.data.startswith('approve_payment_'):
         if user_id == ADMIN_ID:
             request_id = query.data.split('_')[2]
@@ -378,6 +1416,8 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Get User Balance", callback_data='admin_get_balance')],
         [InlineKeyboardButton("➕ Add Balance to User", callback_data='admin_add_balance')],
         [InlineKeyboardButton("💸 Pending Withdrawals", callback_data='admin_show_pending_withdrawals')],
+        [InlineKeyboardButton("⚙️ Economics Settings", callback_data='admin_settings')],
+        [InlineKeyboardButton("🐢 Slowest Updates", callback_data='admin_slow_updates')],
         [InlineKeyboardButton("↩️ Back to Main Menu", callback_data='back_to_main')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -393,6 +1433,53 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
 
+def format_setting(name, value):
+    if name == 'api_token':
+        return f"{value[:4]}…{value[-4:]}" if len(value) > 8 else "set"
+    return f"{value:g}"
+
+async def admin_show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    settings = await asyncio.to_thread(load_settings)
+    lines = [f"{SETTING_LABELS[name]}: {format_setting(name, settings[name])}" for name in SETTINGS_DEFAULTS]
+    keyboard = [
+        [InlineKeyboardButton(f"✏️ {SETTING_LABELS[name]}", callback_data=f"admin_set_{name}")]
+        for name in SETTINGS_DEFAULTS
+    ]
+    keyboard.append([InlineKeyboardButton("↩️ Back to Admin Menu", callback_data='admin_main_menu')])
+    await update.callback_query.edit_message_text(
+        "⚙️ Economics Settings (changes apply immediately):\n\n" + "\n".join(lines),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def admin_show_slow_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Admin Menu", callback_data='admin_main_menu')]])
+    if not slow_updates.enabled:
+        await update.callback_query.edit_message_text(
+            "🐢 Slow-update capture is off. Turn it on with /profile slow on.",
+            reply_markup=back_markup
+        )
+        return
+
+    entries = slow_updates.slowest()[:10]
+    if not entries:
+        await update.callback_query.edit_message_text(
+            f"✅ No updates slower than {SLOW_UPDATE_THRESHOLD * 1000:.0f} ms recorded yet.",
+            reply_markup=back_markup
+        )
+        return
+
+    lines = []
+    for entry in entries:
+        phases = " · ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in sorted(entry['phases'].items()))
+        lines.append(
+            f"{entry['duration'] * 1000:.0f} ms — {entry['handler']} (user {entry['user_id']}, "
+            f"{entry['at'].strftime('%H:%M:%S')} UTC)\n    {phases or 'no DB/API/shortener time'}"
+        )
+    await update.callback_query.edit_message_text(
+        "🐢 Slowest recent updates:\n\n" + "\n".join(lines),
+        reply_markup=back_markup
+    )
+
 async def admin_show_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pending_requests = list(withdrawal_requests.find({"status": "pending"}))
 
@@ -421,7 +1508,7 @@ async def admin_show_withdrawals(update: Update, context: ContextTypes.DEFAULT_T
                     caption=f"QR for User `{req['user_id']}` (Amount: ₹{req['amount']:.2f})"
                 )
             except Exception as e:
-                logger.error(f"Failed to resend QR photo to admin for request {req['_id']}: {e}")
+                logger.error("Failed to resend QR photo to admin for request %s: %s", req['_id'], e)
                 details_str += "\n_ (Could not resend QR photo) _"
 
         message_text = (
@@ -453,20 +1540,19 @@ async def admin_approve_payment(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer("Processing payment approval...")
 
     try:
-        request = withdrawal_requests.find_one_and_update(
-            {"_id": ObjectId(request_id), "status": "pending"},
-            {"$set": {"status": "completed", "completed_at": datetime.utcnow()}},
-            return_document=True
-        )
-
-        if request:
-            user_id = request['user_id']
-            amount = request['amount']
-            withdrawal_method = request['withdrawal_details']['method']
+        def approve(session):
+            request = withdrawal_requests.find_one_and_update(
+                {"_id": ObjectId(request_id), "status": "pending"},
+                {"$set": {"status": "completed", "completed_at": datetime.utcnow()}},
+                return_document=True,
+                session=session
+            )
+            if not request:
+                return None
 
             # --- RESET USER'S EARNING DATA AFTER SUCCESSFUL PAYMENT ---
             users.update_one(
-                {"user_id": user_id},
+                {"user_id": request['user_id']},
                 {"$set": {
                     "balance": 0.0,
                     "referrals": 0,
@@ -475,35 +1561,31 @@ async def admin_approve_payment(update: Update, context: ContextTypes.DEFAULT_TY
                     "referred_by": None
                 },
                     "$inc": {
-                        "withdrawn": amount
+                        "withdrawn": request['amount']
                     }
-                }
+                },
+                session=session
             )
-            logger.info(f"User {user_id}'s earning data reset after successful withdrawal.")
+            # The user is notified by the outbox notifier
+            enqueue_notification('withdrawal_completed', request['_id'], {
+                "user_id": request['user_id'],
+                "amount": request['amount'],
+                "method": request['withdrawal_details']['method']
+            }, session)
+            return request
 
-            # Notify the user
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"🎉 **Payment Successful!** 🎉\n\n"
-                         f"Your withdrawal request of ₹{amount:.2f} via {withdrawal_method} has been successfully processed.\n"
-                         f"Your earning balance has been reset to start fresh. Thank you for using Earn Bot!",
-                    parse_mode='Markdown'
-                )
-                await query.edit_message_text(
-                    f"✅ Payment for User `{user_id}` (Request ID: `{request_id}`) marked as Paid and user notified.\n"
-                    f"User's earning data has been reset.",
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Pending List", callback_data='admin_show_pending_withdrawals')]])
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {user_id} about successful payment: {e}")
-                await query.edit_message_text(
-                    f"✅ Payment for User `{user_id}` (Request ID: `{request_id}`) marked as Paid, but failed to notify user.\n"
-                    f"User's earning data has been reset.",
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Pending List", callback_data='admin_show_pending_withdrawals')]])
-                )
+        request = run_in_transaction(approve)
+
+        if request:
+            user_id = request['user_id']
+            logger.info("User %s's earning data reset after successful withdrawal.", user_id)
+            wake_notifier(context)
+            await query.edit_message_text(
+                f"✅ Payment for User `{user_id}` (Request ID: `{request_id}`) marked as Paid. The user will be notified shortly.\n"
+                f"User's earning data has been reset.",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Pending List", callback_data='admin_show_pending_withdrawals')]])
+            )
 
         else:
             await query.edit_message_text(
@@ -512,13 +1594,277 @@ async def admin_approve_payment(update: Update, context: ContextTypes.DEFAULT_TY
             )
 
     except Exception as e:
-        logger.error(f"Error processing payment approval for request {request_id}: {e}")
+        logger.error("Error processing payment approval for request %s: %s", request_id, e)
         await query.edit_message_text(
             f"❌ An error occurred while approving this payment: {e}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Pending List", callback_data='admin_show_pending_withdrawals')]])
         )
 
 
+def parse_bank_details(raw):
+    """Parses the 'Key: value' bank details a user sends into payout fields."""
+    fields = {"holder": "", "account": "", "ifsc": "", "bank": ""}
+    keys = {
+        "account holder name": "holder",
+        "account number": "account",
+        "ifsc code": "ifsc",
+        "ifsc": "ifsc",
+        "bank name": "bank",
+    }
+    for line in raw.splitlines():
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        field = keys.get(key.strip().lower())
+        if field:
+            fields[field] = value.strip()
+    return fields
+
+def _export_header(export_format):
+    if export_format == 'upi':
+        return ["Beneficiary VPA", "Amount", "Beneficiary Name", "Remarks"]
+    if export_format == 'bank':
+        return ["Beneficiary Name", "Account Number", "IFSC", "Amount", "Payment Mode", "Remarks"]
+    return ["Request ID", "User ID", "Username", "Amount", "Method", "UPI ID", "Account Holder Name",
+            "Account Number", "IFSC", "Bank Name", "QR File ID", "Status", "Requested On (UTC)"]
+
+# Leading characters that make spreadsheet apps treat a cell as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def _safe_cell(value):
+    """Neutralizes user-supplied text that a spreadsheet would evaluate as a formula."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+class IncompleteBankDetails(Exception):
+    """Raised for bank requests without an account number or IFSC to pay to."""
+
+def _export_row(export_format, req, username):
+    """Returns the CSV row for a request, or None if it does not belong in this format.
+
+    Raises IncompleteBankDetails for bank payout rows that could not be paid.
+    """
+    details = req['withdrawal_details']
+    method = details['method']
+    remarks = f"EarnBot payout {req['_id']}"
+    bank = parse_bank_details(details.get('details', '')) if method == "Bank Account" else None
+
+    if export_format == 'upi':
+        if method != "UPI ID":
+            return None
+        return [details['id'], f"{req['amount']:.2f}", username, remarks]
+    if export_format == 'bank':
+        if method != "Bank Account":
+            return None
+        if not bank['account'] or not bank['ifsc']:
+            raise IncompleteBankDetails(str(req['_id']))
+        return [bank['holder'] or username, bank['account'], bank['ifsc'].upper(),
+                f"{req['amount']:.2f}", "NEFT", remarks]
+    return [
+        str(req['_id']),
+        req['user_id'],
+        username,
+        f"{req['amount']:.2f}",
+        method,
+        details.get('id', ''),
+        bank['holder'] if bank else '',
+        bank['account'] if bank else '',
+        bank['ifsc'] if bank else '',
+        bank['bank'] if bank else '',
+        details.get('file_id', ''),
+        req['status'],
+        req['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+    ]
+
+def _write_export_batch(writer, export_format, batch, skipped):
+    user_ids = list({req['user_id'] for req in batch})
+    usernames = {
+        doc['user_id']: doc.get('username')
+        for doc in users.find({"user_id": {"$in": user_ids}}, {"user_id": 1, "username": 1})
+    }
+    written = 0
+    for req in batch:
+        username = usernames.get(req['user_id']) or f"User_{req['user_id']}"
+        try:
+            row = _export_row(export_format, req, username)
+        except IncompleteBankDetails:
+            skipped.append(str(req['_id']))
+            continue
+        if row is not None:
+            writer.writerow([_safe_cell(cell) for cell in row])
+            written += 1
+    return written
+
+def write_payout_export(file_obj, export_format, query, collections=(withdrawal_requests,)):
+    """Streams matching withdrawal requests from collections into file_obj as CSV.
+
+    Requests are read through a server-side cursor and users are joined one
+    batch at a time, so memory use does not depend on how many rows match.
+    Returns the number of rows written and the ids of requests left out
+    because their bank details are incomplete.
+    """
+    writer = csv.writer(file_obj)
+    writer.writerow(_export_header(export_format))
+
+    written = 0
+    skipped = []
+    for collection in collections:
+        cursor = collection.find(
+            query,
+            {"user_id": 1, "amount": 1, "withdrawal_details": 1, "status": 1, "timestamp": 1}
+        ).sort("timestamp", 1).batch_size(EXPORT_BATCH_SIZE)
+
+        batch = []
+        try:
+            for req in cursor:
+                batch.append(req)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    written += _write_export_batch(writer, export_format, batch, skipped)
+                    batch = []
+            if batch:
+                written += _write_export_batch(writer, export_format, batch, skipped)
+        finally:
+            cursor.close()
+    return written, skipped
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|upi|bank] [from YYYY-MM-DD] [to YYYY-MM-DD]
+
+    Without dates only pending requests are exported. With dates the csv audit
+    export includes every request created in that range, whatever its status,
+    archived ones too; the upi/bank payout files stay limited to pending
+    requests so uploading one never pays a request twice.
+    """
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+
+    args = context.args or []
+    export_format = args[0].lower() if args else 'csv'
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text(
+            "Usage: /export [csv|upi|bank] [from YYYY-MM-DD] [to YYYY-MM-DD]\n"
+            "Without dates only pending requests are exported; upi/bank files are always pending-only."
+        )
+        return
+
+    query = {"status": "pending"}
+    collections = (withdrawal_requests,)
+    try:
+        if len(args) > 1:
+            start_date = datetime.strptime(args[1], '%Y-%m-%d')
+            end_date = datetime.strptime(args[2], '%Y-%m-%d') if len(args) > 2 else datetime.utcnow()
+            query["timestamp"] = {"$gte": start_date, "$lt": end_date + timedelta(days=1)}
+            if export_format == 'csv':
+                del query["status"]
+                # Older completed requests have been moved to the archive
+                collections = (withdrawal_requests, withdrawal_archive)
+    except ValueError:
+        await update.message.reply_text("Invalid date. Please use the YYYY-MM-DD format.")
+        return
+
+    await update.message.reply_text("⏳ Preparing payout export...")
+
+    tmp = tempfile.NamedTemporaryFile('w', newline='', encoding='utf-8', suffix='.csv', delete=False)
+    try:
+        with tmp:
+            row_count, skipped = await asyncio.to_thread(write_payout_export, tmp, export_format, query, collections)
+
+        if skipped:
+            await update.message.reply_text(
+                f"⚠️ {len(skipped)} bank request(s) left out because the account number or IFSC is missing:\n"
+                + "\n".join(f"`{request_id}`" for request_id in skipped[:50])
+                + ("\n…" if len(skipped) > 50 else ""),
+                parse_mode='Markdown'
+            )
+
+        if row_count == 0:
+            await update.message.reply_text("✅ No withdrawal requests matched this export.")
+            return
+
+        filename = f"payouts_{export_format}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv"
+        with open(tmp.name, 'rb') as export_file:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=export_file,
+                filename=filename,
+                caption=f"📤 {row_count} withdrawal request(s) exported ({export_format.upper()})."
+            )
+    except Exception as e:
+        logger.error("Failed to export withdrawal requests: %s", e)
+        await update.message.reply_text(f"❌ Export failed: {e}")
+    finally:
+        os.remove(tmp.name)
+
+
+_profile_running = False
+# One thread of its own, so a run of up to PROFILE_MAX_SECONDS does not hold a default-executor worker
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiler')
+
+async def _run_profile(bot, chat_id, thread_id, seconds):
+    global _profile_running
+    profiler = SamplingProfiler(thread_id)
+    try:
+        await asyncio.get_running_loop().run_in_executor(profile_executor, profiler.run, seconds, shutdown_requested)
+        tmp = tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.folded', delete=False)
+        with tmp:
+            profiler.write_collapsed(tmp)
+        try:
+            with open(tmp.name, 'rb') as profile_file:
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=profile_file,
+                    filename=f"profile_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.folded",
+                    caption=f"🔥 {sum(profiler.samples.values())} samples over {seconds}s. "
+                            f"Collapsed stacks; open with speedscope.app or flamegraph.pl."
+                )
+        finally:
+            os.remove(tmp.name)
+    except Exception as e:
+        logger.error("Profiling run failed: %s", e)
+        await bot.send_message(chat_id=chat_id, text=f"❌ Profiling failed: {e}")
+    finally:
+        _profile_running = False
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [seconds] samples the event loop thread; /profile slow on|off toggles slow-update capture."""
+    global _profile_running
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+
+    args = context.args or []
+    if args and args[0].lower() == 'slow':
+        if len(args) > 1 and args[1].lower() in ('on', 'off'):
+            slow_updates.enabled = args[1].lower() == 'on'
+        await update.message.reply_text(
+            f"🐢 Slow-update capture is {'on' if slow_updates.enabled else 'off'} "
+            f"(threshold {SLOW_UPDATE_THRESHOLD * 1000:.0f} ms)."
+        )
+        return
+
+    try:
+        seconds = int(args[0]) if args else 30
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds] or /profile slow on|off")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if _profile_running:
+        await update.message.reply_text("⏳ A profiling run is already in progress.")
+        return
+    _profile_running = True
+
+    # Handlers run on the event loop thread, which is the one worth sampling
+    context.application.create_task(
+        _run_profile(context.bot, update.effective_chat.id, threading.get_ident(), seconds)
+    )
+    await update.message.reply_text(f"🔥 Profiling for {seconds}s. The result will be sent as a document.")
+
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != ADMIN_ID:
@@ -556,10 +1902,13 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             target_user_id = int(text_input)
             target_user = users.find_one({"user_id": target_user_id})
             if target_user:
+                totals = withdrawal_totals.find_one({"user_id": target_user_id}) or {}
                 await update.message.reply_text(
                     f"User ID: `{target_user_id}`\n"
                     f"Balance: ₹{target_user['balance']:.2f}\n"
                     f"Total Earned: ₹{target_user['total_earned']:.2f}\n"
+                    f"Withdrawn: ₹{target_user['withdrawn']:.2f}\n"
+                    f"Archived Payouts: {totals.get('archived_count', 0)} (₹{totals.get('archived_amount', 0.0):.2f})\n"
                     f"Referrals: {target_user['referrals']}\n"
                     f"Referred By: {target_user['referred_by'] if target_user.get('referred_by') else 'N/A'}",
                     parse_mode='Markdown',
@@ -638,33 +1987,149 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if 'target_user_id_for_add' in context.user_data:
                 del context.user_data['target_user_id_for_add']
 
+    elif current_state == 'SET_SETTING_VALUE':
+        setting_name = context.user_data.pop('setting_to_change', None)
+        back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Settings", callback_data='admin_settings')]])
+        try:
+            if setting_name not in SETTINGS_DEFAULTS:
+                await update.message.reply_text(
+                    "Error: No setting selected. Please choose one from 'Economics Settings'.",
+                    reply_markup=back_markup
+                )
+                return
+            value = parse_setting_value(setting_name, text_input)
+            set_setting(setting_name, value)
+            logger.info("Admin changed setting %s.", setting_name)
+            await update.message.reply_text(
+                f"✅ {SETTING_LABELS[setting_name]} updated to {format_setting(setting_name, value)}.",
+                reply_markup=back_markup
+            )
+        except ValueError as e:
+            await update.message.reply_text(f"Invalid value: {e}", reply_markup=back_markup)
+        finally:
+            clear_user_state(user_id)
+
     elif current_state == 'BROADCAST_MESSAGE':
-        message_to_broadcast = text_input
-        sent_count = 0
-        failed_count = 0
-        all_users = users.find({}, {"user_id": 1})
+        clear_user_state(user_id)
+        now = datetime.utcnow()
+        broadcast_id = broadcast_jobs.insert_one({
+            "message": text_input,
+            "last_user_doc_id": None,
+            "sent": 0,
+            "failed": 0,
+            "status": "running",
+            "owner": BROADCAST_OWNER,
+            "lease_until": now + BROADCAST_LEASE,
+            "created_at": now
+        }).inserted_id
+        await update.message.reply_text("📣 Broadcast started. You will get a summary when it completes.")
+        start_broadcast(context.application, broadcast_id)
+
+
+# Broadcasts run as tasks tracked here so graceful_shutdown() can wait for their checkpoints
+broadcast_tasks = set()
+
+def start_broadcast(application, broadcast_id):
+    task = application.create_task(run_broadcast(application.bot, broadcast_id), name=f"broadcast:{broadcast_id}")
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+    return task
+
+def claim_broadcast():
+    """Takes the lease on one unfinished broadcast nobody holds; returns its id or None.
+
+    Paused broadcasts hold no lease, and a running one whose owner stopped
+    renewing it (e.g. a crashed process) is free once the lease expires.
+    """
+    now = datetime.utcnow()
+    job = broadcast_jobs.find_one_and_update(
+        {"status": {"$in": ["running", "paused"]},
+         "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "owner": BROADCAST_OWNER, "lease_until": now + BROADCAST_LEASE}},
+        projection={"_id": 1}
+    )
+    return job['_id'] if job else None
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    """Job taking over broadcasts that are paused or whose owner's lease expired."""
+    application = context.application
+    while not shutdown_requested.is_set():
+        broadcast_id = await asyncio.to_thread(claim_broadcast)
+        if broadcast_id is None:
+            break
+        logger.info("Resuming broadcast %s.", broadcast_id)
+        start_broadcast(application, broadcast_id)
+
+
+async def run_broadcast(bot, broadcast_id):
+    """Sends a leased broadcast from its last checkpoint; returns True once it has completed."""
+    job = broadcast_jobs.find_one({"_id": broadcast_id})
+    sent_count = job['sent']
+    failed_count = job['failed']
+    last_user_doc_id = job['last_user_doc_id']
+    last_checkpoint = time.monotonic()
+
+    def checkpoint(status):
+        """Saves progress; returns False if another process has taken the lease."""
+        now = datetime.utcnow()
+        lease = {"owner": BROADCAST_OWNER, "lease_until": now + BROADCAST_LEASE} if status == 'running' else \
+            {"owner": None, "lease_until": None}
+        result = broadcast_jobs.update_one(
+            {"_id": broadcast_id, "owner": BROADCAST_OWNER},
+            {"$set": {
+                "last_user_doc_id": last_user_doc_id,
+                "sent": sent_count,
+                "failed": failed_count,
+                "status": status,
+                "updated_at": now,
+                **lease
+            }}
+        )
+        return result.matched_count == 1
 
+    query = {"_id": {"$gt": last_user_doc_id}} if last_user_doc_id else {}
+    all_users = users.find(query, {"user_id": 1}).sort("_id", 1)
+    try:
         for user_doc in all_users:
+            if shutdown_requested.is_set():
+                checkpoint('paused')
+                logger.info("Broadcast %s paused for shutdown after %s recipients.", broadcast_id, sent_count + failed_count)
+                return False
             try:
-                await context.bot.send_message(chat_id=user_doc['user_id'], text=message_to_broadcast)
+                await bot.send_message(chat_id=user_doc['user_id'], text=job['message'])
                 sent_count += 1
             except TelegramError as e:
                 if "blocked by the user" in str(e) or "user is deactivated" in str(e):
-                    logger.info(f"User {user_doc['user_id']} blocked the bot or is deactivated. Skipping.")
+                    logger.info("User %s blocked the bot or is deactivated. Skipping.", user_doc['user_id'])
                 else:
-                    logger.warning(f"Failed to send broadcast to user {user_doc['user_id']}: {e}")
+                    logger.warning("Failed to send broadcast to user %s: %s", user_doc['user_id'], e)
                 failed_count += 1
             except Exception as e:
                 failed_count += 1
-                logger.warning(f"An unexpected error occurred sending broadcast to user {user_doc['user_id']}: {e}")
-
-        await update.message.reply_text(
-            f"✅ Broadcast complete!\n"
-            f"Sent to: {sent_count} users.\n"
-            f"Failed for: {failed_count} users.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Admin Menu", callback_data='admin_main_menu')]])
-        )
-        clear_user_state(user_id)
+                logger.warning("An unexpected error occurred sending broadcast to user %s: %s", user_doc['user_id'], e)
+            last_user_doc_id = user_doc['_id']
+            if ((sent_count + failed_count) % BROADCAST_CHECKPOINT_EVERY == 0
+                    or time.monotonic() - last_checkpoint >= BROADCAST_HEARTBEAT):
+                last_checkpoint = time.monotonic()
+                if not checkpoint('running'):
+                    logger.warning("Broadcast %s was taken over by another process; stopping here.", broadcast_id)
+                    return False
+    except asyncio.CancelledError:
+        checkpoint('paused')
+        logger.info("Broadcast %s paused on cancellation after %s recipients.", broadcast_id, sent_count + failed_count)
+        raise
+    finally:
+        all_users.close()
+
+    checkpoint('done')
+    await bot.send_message(
+        chat_id=ADMIN_ID,
+        text=f"✅ Broadcast complete!\n"
+             f"Sent to: {sent_count} users.\n"
+             f"Failed for: {failed_count} users.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Back to Admin Menu", callback_data='admin_main_menu')]])
+    )
+    return True
 
 
 # --- User Withdrawal Input Handler ---
@@ -672,17 +2137,26 @@ async def handle_withdrawal_input_wrapper(update: Update, context: ContextTypes.
     user_id = update.effective_user.id
     current_state = get_user_state(user_id)
     user = get_user(user_id)
+    min_withdrawal = get_setting('min_withdrawal')
 
     # If not in a withdrawal state, or if balance is insufficient, ignore/reset
-    if not current_state or not current_state.startswith('WITHDRAW_') or user['balance'] < MIN_WITHDRAWAL:
-        if user['balance'] < MIN_WITHDRAWAL:
+    if not current_state or not current_state.startswith('WITHDRAW_') or user['balance'] < min_withdrawal:
+        if user['balance'] < min_withdrawal:
             await update.message.reply_text(
-                f"❌ Your balance (₹{user['balance']:.2f}) is below the minimum withdrawal amount of ₹{MIN_WITHDRAWAL:.2f}.",
+                f"❌ Your balance (₹{user['balance']:.2f}) is below the minimum withdrawal amount of ₹{min_withdrawal:.2f}.",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Main Menu", callback_data='back_to_main')]])
             )
         clear_user_state(user_id)
         return
 
+    if has_pending_withdrawal(user_id):
+        await update.message.reply_text(
+            "⏳ You already have a pending withdrawal request. Please wait for it to be processed.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Main Menu", callback_data='back_to_main')]])
+        )
+        clear_user_state(user_id)
+        return
+
     # Proceed based on specific withdrawal state
     if current_state == 'WITHDRAW_ENTER_UPI':
         upi_id = update.message.text.strip()
@@ -716,7 +2190,7 @@ async def handle_withdrawal_input_wrapper(update: Update, context: ContextTypes.
             return
 
     else:
-        logger.warning(f"User {user_id} sent message while in unexpected state: {current_state}")
+        logger.warning("User %s sent message while in unexpected state: %s", user_id, current_state)
         await update.message.reply_text(
             "It looks like you're in an unexpected state. Please try again from the main menu or click 'Cancel'.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Main Menu", callback_data='back_to_main')]])
@@ -725,8 +2199,7 @@ async def handle_withdrawal_input_wrapper(update: Update, context: ContextTypes.
 
 
 async def process_withdrawal_request(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, amount: float, details: dict):
-    """Handles the common logic for creating and notifying about a withdrawal request."""
-    # Record the withdrawal request
+    """Records a withdrawal request; the admin is notified by the outbox notifier."""
     request_data = {
         "user_id": user_id,
         "amount": amount,
@@ -734,8 +2207,30 @@ async def process_withdrawal_request(update: Update, context: ContextTypes.DEFAU
         "timestamp": datetime.utcnow(),
         "status": "pending"
     }
-    inserted_result = withdrawal_requests.insert_one(request_data)
-    request_obj_id = inserted_result.inserted_id
+    notification_payload = {
+        "user_id": user_id,
+        "amount": amount,
+        "withdrawal_details": details,
+        "chat_id": update.message.chat_id,
+        "message_id": update.message.message_id
+    }
+
+    # Record the withdrawal request and its admin notification together
+    def record(session):
+        inserted_result = withdrawal_requests.insert_one(request_data, session=session)
+        enqueue_notification('withdrawal_created', inserted_result.inserted_id, notification_payload, session)
+
+    try:
+        run_in_transaction(record)
+    except DuplicateKeyError:
+        # Lost a race with another request from the same user (user_id_pending_unique)
+        await update.message.reply_text(
+            "⏳ You already have a pending withdrawal request. Please wait for it to be processed.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Main Menu", callback_data='back_to_main')]])
+        )
+        return
+    finally:
+        clear_user_state(user_id)
 
     # DO NOT increment 'withdrawn' here. 'withdrawn' is incremented in admin_approve_payment
     # when the balance is reset. This prevents double counting.
@@ -748,12 +2243,79 @@ async def process_withdrawal_request(update: Update, context: ContextTypes.DEFAU
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Main Menu", callback_data='back_to_main')]])
     )
+    wake_notifier(context)
+
+
+# --- Notification outbox ---
+# Handlers only enqueue notification events next to the write that caused them;
+# process_notification_outbox() sends them from the job queue, retrying
+# failures with backoff, so a slow or failing send never holds up the user.
+def enqueue_notification(event_type, request_id, payload, session=None):
+    now = datetime.utcnow()
+    notification_outbox.insert_one({
+        "dedupe_key": f"{event_type}:{request_id}",
+        "type": event_type,
+        "request_id": request_id,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now
+    }, session=session)
+
+def wake_notifier(context: ContextTypes.DEFAULT_TYPE):
+    """Runs the notifier right away instead of waiting for its next interval."""
+    if context.job_queue is not None:
+        context.job_queue.run_once(with_log_context(process_notification_outbox), 0)
+
+def _claim_notifications():
+    now = datetime.utcnow()
+    # Requeue events whose sender died mid-send
+    notification_outbox.update_many(
+        {"status": "sending", "claimed_at": {"$lt": now - OUTBOX_CLAIM_TIMEOUT}},
+        {"$set": {"status": "pending"}}
+    )
+    claimed = []
+    for _ in range(OUTBOX_BATCH_SIZE):
+        event = notification_outbox.find_one_and_update(
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"$set": {"status": "sending", "claimed_at": now}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not event:
+            break
+        claimed.append(event)
+    return claimed
+
+class NotificationProgress:
+    """Steps of a multi-message event already delivered, persisted on the outbox document.
+
+    A retry after a partial failure resumes at the first step not yet sent
+    instead of sending the earlier messages again.
+    """
+
+    def __init__(self, event):
+        self.event_id = event['_id']
+        self.done = set(event.get('steps_done', []))
 
-    # Notify admin
+    async def step(self, name, send):
+        """Awaits ``send()`` unless step ``name`` was already delivered, then records it."""
+        if name in self.done:
+            return
+        await send()
+        self.done.add(name)
+        await asyncio.to_thread(
+            notification_outbox.update_one, {"_id": self.event_id}, {"$addToSet": {"steps_done": name}}
+        )
+
+async def _send_withdrawal_created(bot, payload, request_id, progress):
+    user_id = payload['user_id']
+    details = payload['withdrawal_details']
     admin_message = (
         f"🚨 **New Withdrawal Request!** 🚨\n"
         f"User ID: [`{user_id}`](tg://user?id={user_id})\n"
-        f"Amount: ₹{amount:.2f}\n"
+        f"Amount: ₹{payload['amount']:.2f}\n"
         f"Method: {details['method']}\n"
     )
 
@@ -764,32 +2326,98 @@ async def process_withdrawal_request(update: Update, context: ContextTypes.DEFAU
     elif details['method'] == "QR Code":
         admin_message += f"QR Code File ID: `{details['file_id']}`\n(QR image sent separately below)"
 
-    admin_keyboard = [[InlineKeyboardButton("✅ Mark as Paid", callback_data=f"approve_payment_{request_obj_id}")]]
+    admin_keyboard = [[InlineKeyboardButton("✅ Mark as Paid", callback_data=f"approve_payment_{request_id}")]]
 
-    try:
-        await context.bot.send_message(
+    await progress.step('alert', lambda: bot.send_message(
+        chat_id=ADMIN_ID,
+        text=admin_message,
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(admin_keyboard)
+    ))
+    if details['method'] == "QR Code":
+        await progress.step('forward', lambda: bot.forward_message(
+            chat_id=ADMIN_ID,
+            from_chat_id=payload['chat_id'],
+            message_id=payload['message_id']
+        ))
+        await progress.step('followup', lambda: bot.send_message(
             chat_id=ADMIN_ID,
-            text=admin_message,
+            text=f"⬆️ Above QR code is for User ID `{user_id}` withdrawal (Request ID: `{request_id}`).",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(admin_keyboard)
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Open User Chat", url=f"tg://user?id={user_id}")]])
+        ))
+
+async def _send_withdrawal_completed(bot, payload, request_id, progress):
+    await bot.send_message(
+        chat_id=payload['user_id'],
+        text=f"🎉 **Payment Successful!** 🎉\n\n"
+             f"Your withdrawal request of ₹{payload['amount']:.2f} via {payload['method']} has been successfully processed.\n"
+             f"Your earning balance has been reset to start fresh. Thank you for using Earn Bot!",
+        parse_mode='Markdown'
+    )
+
+NOTIFICATION_SENDERS = {
+    'withdrawal_created': _send_withdrawal_created,
+    'withdrawal_completed': _send_withdrawal_completed,
+}
+
+async def process_notification_outbox(context: ContextTypes.DEFAULT_TYPE):
+    await send_due_notifications(context.bot)
+
+async def send_due_notifications(bot):
+    """Sends a batch of due outbox events and records the outcome of each in one bulk_write.
+
+    Returns the number of events handled.
+    """
+    events = await asyncio.to_thread(_claim_notifications)
+    if not events:
+        return 0
+
+    # An admin alert for a request that is no longer pending is stale; skip it
+    created_ids = [event['request_id'] for event in events if event['type'] == 'withdrawal_created']
+    still_pending = set()
+    if created_ids:
+        pending_docs = await asyncio.to_thread(
+            lambda: list(withdrawal_requests.find({"_id": {"$in": created_ids}, "status": "pending"}, {"_id": 1}))
         )
-        if details['method'] == "QR Code" and update.message.photo:
-            await context.bot.forward_message(
-                chat_id=ADMIN_ID,
-                from_chat_id=update.message.chat_id,
-                message_id=update.message.message_id
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"⬆️ Above QR code is for User ID `{user_id}` withdrawal (Request ID: `{request_obj_id}`).",
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Open User Chat", url=f"tg://user?id={user_id}")]])
-            )
+        still_pending = {doc['_id'] for doc in pending_docs}
+
+    now = datetime.utcnow()
+    outcomes = []
+    for event in events:
+        if event['type'] == 'withdrawal_created' and event['request_id'] not in still_pending:
+            outcomes.append(UpdateOne({"_id": event['_id']}, {"$set": {"status": "skipped", "sent_at": now}}))
+            continue
+        try:
+            await NOTIFICATION_SENDERS[event['type']](bot, event['payload'], event['request_id'], NotificationProgress(event))
+            outcomes.append(UpdateOne({"_id": event['_id']}, {"$set": {"status": "sent", "sent_at": datetime.utcnow()}}))
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            outcomes.append(UpdateOne(
+                {"_id": event['_id']},
+                {"$set": {"status": "pending", "next_attempt_at": now + timedelta(seconds=retry_after)},
+                 "$inc": {"attempts": -1}}  # rate limiting is not the event's fault
+            ))
+        except (Forbidden, BadRequest) as e:
+            # Blocked bot, deleted chat or malformed message: retrying will not help
+            logger.error("Dropping %s notification for request %s: %s", event['type'], event['request_id'], e)
+            outcomes.append(UpdateOne({"_id": event['_id']}, {"$set": {"status": "failed", "error": str(e)}}))
+        except Exception as e:
+            if event['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                logger.error("Giving up on %s notification for request %s after %s attempts: %s",
+                             event['type'], event['request_id'], event['attempts'], e)
+                outcomes.append(UpdateOne({"_id": event['_id']}, {"$set": {"status": "failed", "error": str(e)}}))
+            else:
+                backoff = timedelta(seconds=min(3600, 5 * 2 ** event['attempts']))
+                logger.warning("Failed to send %s notification for request %s, retrying in %ss: %s",
+                               event['type'], event['request_id'], int(backoff.total_seconds()), e)
+                outcomes.append(UpdateOne(
+                    {"_id": event['_id']},
+                    {"$set": {"status": "pending", "next_attempt_at": now + backoff, "error": str(e)}}
+                ))
 
-    except TelegramError as e:
-        logger.error(f"Failed to notify admin {ADMIN_ID} about withdrawal request: {e}")
-    finally:
-        clear_user_state(user_id)
+    await asyncio.to_thread(notification_outbox.bulk_write, outcomes, ordered=False)
+    return len(events)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -800,14 +2428,14 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await update.callback_query.message.reply_text('⚠️ An error occurred. Please try again.')
             except Exception as e:
-                logger.error(f"Failed to send error message to callback_query user: {e}")
+                logger.error("Failed to send error message to callback_query user: %s", e)
         elif update.message:
             try:
                 await update.message.reply_text('⚠️ An error occurred. Please try again.')
             except Exception as e:
-                logger.error(f"Failed to send error message to message user: {e}")
+                logger.error("Failed to send error message to message user: %s", e)
         else:
-            logger.warning(f"Error occurred with unhandled update type: {update}")
+            logger.warning("Error occurred with unhandled update type: %s", update)
     else:
         logger.warning("Error handler called with None update object.")
 
@@ -821,7 +2449,7 @@ async def cleanup_old_data(context: ContextTypes.DEFAULT_TYPE):
     db_usage_percentage = 95  # Placeholder
 
     if db_usage_percentage >= 90:  # Only run cleanup if usage is high
-        logger.warning(f"MongoDB usage is at {db_usage_percentage:.2f}%. Initiating cleanup of old data.")
+        logger.warning("MongoDB usage is at %.2f%%. Initiating cleanup of old data.", db_usage_percentage)
 
         thirty_days_ago = datetime.utcnow() - timedelta(days=30)
 
@@ -847,7 +2475,7 @@ async def cleanup_old_data(context: ContextTypes.DEFAULT_TYPE):
         deleted_user_ids = []
         for user_doc in users_to_delete:
             if user_doc['user_id'] == ADMIN_ID or user_doc['balance'] > 0.0:
-                logger.warning(f"Attempted to delete user {user_doc['user_id']} with non-zero balance or ADMIN_ID during cleanup. Skipping.")
+                logger.warning("Attempted to delete user %s with non-zero balance or ADMIN_ID during cleanup. Skipping.", user_doc['user_id'])
                 continue
 
             try:
@@ -856,9 +2484,10 @@ async def cleanup_old_data(context: ContextTypes.DEFAULT_TYPE):
                 deleted_count += 1
                 deleted_user_ids.append(user_doc['user_id'])
             except Exception as e:
-                logger.error(f"Error deleting user {user_doc['user_id']} during cleanup: {e}")
+                logger.error("Error deleting user %s during cleanup: %s", user_doc['user_id'], e)
 
-        logger.info(f"MongoDB cleanup complete. Deleted {deleted_count} users. User IDs: {deleted_user_ids}")
+        logger.info("MongoDB cleanup complete. Deleted %s users.", deleted_count)
+        logger.debug("Users deleted during cleanup: %s", deleted_user_ids)
 
         admin_msg = f"🧹 **MongoDB Cleanup Alert!** 🧹\n" \
                     f"Database usage was high ({db_usage_percentage:.2f}%).\n" \
@@ -869,39 +2498,301 @@ async def cleanup_old_data(context: ContextTypes.DEFAULT_TYPE):
                 chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown'
             )
         except Exception as e:
-            logger.error(f"Failed to send cleanup notification to admin: {e}")
+            logger.error("Failed to send cleanup notification to admin: %s", e)
     else:
-        logger.info(f"MongoDB usage is at {db_usage_percentage:.2f}%, no cleanup needed yet.")
+        logger.info("MongoDB usage is at %.2f%%, no cleanup needed yet.", db_usage_percentage)
 
 
-# Initialize the Application globally
-application = Application.builder().token(TOKEN).build()
+def _collection_size(name):
+    """(uncompressed data size, storage size on disk) of a collection in bytes, or None if unavailable."""
+    try:
+        stats = get_db().command("collStats", name)
+    except OperationFailure:
+        return None
+    return stats.get("size"), stats.get("storageSize")
+
+def archive_withdrawals(cutoff):
+    """Moves completed requests older than cutoff to withdrawal_archive in batches.
+
+    Returns (moved count, moved amount, moved BSON bytes).
+    """
+    moved_count, moved_amount, moved_bytes = 0, 0.0, 0
+    # Every batch is complete on its own, so a shutdown can stop between any two
+    while not shutdown_requested.is_set():
+        batch = list(withdrawal_requests.find(
+            {"status": "completed", "completed_at": {"$lt": cutoff}}
+        ).sort("completed_at", 1).limit(ARCHIVE_BATCH_SIZE))
+        if not batch:
+            break
+
+        archived_at = datetime.utcnow()
+        user_ids = list({req['user_id'] for req in batch})
+
+        def move(session):
+            withdrawal_archive.bulk_write(
+                [ReplaceOne({"_id": req['_id']}, dict(req, archived_at=archived_at), upsert=True) for req in batch],
+                ordered=False, session=session
+            )
+            totals = withdrawal_archive.aggregate([
+                {"$match": {"user_id": {"$in": user_ids}}},
+                {"$group": {
+                    "_id": "$user_id",
+                    "archived_count": {"$sum": 1},
+                    "archived_amount": {"$sum": "$amount"},
+                    "last_completed_at": {"$max": "$completed_at"}
+                }}
+            ], session=session)
+            withdrawal_totals.bulk_write([
+                UpdateOne(
+                    {"user_id": total['_id']},
+                    {"$set": {key: total[key] for key in ("archived_count", "archived_amount", "last_completed_at")}},
+                    upsert=True
+                )
+                for total in totals
+            ], ordered=False, session=session)
+            withdrawal_requests.delete_many({"_id": {"$in": [req['_id'] for req in batch]}}, session=session)
+
+        run_in_transaction(move)
+        moved_count += len(batch)
+        moved_amount += sum(req['amount'] for req in batch)
+        moved_bytes += sum(len(BSON.encode(req)) for req in batch)
+    return moved_count, moved_amount, moved_bytes
+
+async def archive_completed_withdrawals(context: ContextTypes.DEFAULT_TYPE):
+    """Daily job keeping withdrawal_requests down to the active queue."""
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    logger.info("Archiving withdrawal requests completed before %s...", cutoff)
+
+    size_before = await asyncio.to_thread(_collection_size, 'withdrawal_requests')
+    moved_count, moved_amount, moved_bytes = await asyncio.to_thread(archive_withdrawals, cutoff)
+    if not moved_count:
+        logger.info("No completed withdrawal requests old enough to archive.")
+        return
+    size_after = await asyncio.to_thread(_collection_size, 'withdrawal_requests')
+
+    if size_before is not None and size_after is not None:
+        data_reduced = size_before[0] - size_after[0]
+        storage_line = (f"Storage on disk: {size_before[1] / 1024:.1f} KB → {size_after[1] / 1024:.1f} KB "
+                        f"(freed space is reused by MongoDB rather than returned to the disk).")
+    else:
+        data_reduced = moved_bytes
+        storage_line = "Storage size unavailable."
+    logger.info("Archived %s withdrawal requests (₹%.2f); withdrawal_requests data shrank by %s bytes.",
+                moved_count, moved_amount, data_reduced)
+    try:
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"🗄️ **Withdrawal Archive** 🗄️\n"
+                 f"Moved {moved_count} completed requests (₹{moved_amount:.2f}) older than {ARCHIVE_AFTER_DAYS} days "
+                 f"to the archive.\n"
+                 f"Active collection data size reduced by {data_reduced / 1024:.1f} KB.\n"
+                 f"{storage_line}",
+            parse_mode='Markdown'
+        )
+    except TelegramError as e:
+        logger.error("Failed to send archive notification to admin: %s", e)
+
+
+async def on_startup(application: Application):
+    """Runs once the Application is initialized, before polling starts."""
+    if await asyncio.to_thread(init_db):
+        logger.info("Database indexes reconciled with schema version %s.", INDEX_SCHEMA_VERSION)
+    if 'user_id_pending_unique' in index_conflicts:
+        duplicates = index_conflicts['user_id_pending_unique']
+        lines = "\n".join(
+            f"User `{group['_id']['user_id']}`: " + ", ".join(f"`{request_id}`" for request_id in group['ids'])
+            for group in duplicates
+        )
+        try:
+            await application.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"⚠️ **Duplicate pending withdrawals found**\n\n"
+                     f"These users have more than one pending request, so the one-pending-request "
+                     f"guard could not be enabled:\n{lines}\n\n"
+                     f"Mark the extra requests as paid or remove them; the guard is retried on the next start.",
+                parse_mode='Markdown'
+            )
+        except TelegramError as e:
+            logger.error("Failed to report duplicate pending withdrawals to admin: %s", e)
+    await asyncio.to_thread(load_settings)
+    Thread(target=watch_settings, name="settings-watcher", daemon=True).start()
+    ready.set()
+
+
+async def graceful_shutdown(application: Application):
+    """Drains updates, broadcasts and notifications within SHUTDOWN_DEADLINE and stops the Application.
+
+    Returns a report of what was drained.
+    """
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_DEADLINE
+    ready.clear()
+    shutdown_requested.set()
+    settings_stop_event.set()
+
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+
+    report = {
+        "in_flight_updates": inflight_updates,
+        "queued_updates": application.update_queue.qsize(),
+    }
+
+    # Broadcasts checkpoint at their next recipient; cancel any still running at the deadline
+    tasks = list(broadcast_tasks)
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    report["broadcasts_paused"] = sum(
+        1 for task in tasks if task.cancelled() or (task.exception() is None and task.result() is False)
+    )
+
+    if application.running:
+        try:
+            await asyncio.wait_for(application.stop(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning("Updates and jobs did not finish within the shutdown deadline.")
+    report["updates_left_unprocessed"] = inflight_updates + application.update_queue.qsize()
+
+    notifications_sent = 0
+    while time.monotonic() < deadline:
+        handled = await send_due_notifications(application.bot)
+        if not handled:
+            break
+        notifications_sent += handled
+    report["notifications_flushed"] = notifications_sent
+    report["notifications_pending"] = notification_outbox.count_documents({"status": "pending"})
+    report["seconds"] = round(time.monotonic() - started, 2)
+
+    logger.info("Graceful shutdown drained: %s", report)
+    try:
+        await application.bot.send_message(
+            chat_id=ADMIN_ID,
+            text="🔄 Bot restarting. Drained before shutdown:\n" +
+                 "\n".join(f"{key.replace('_', ' ')}: {value}" for key, value in report.items())
+        )
+    except TelegramError as e:
+        logger.warning("Failed to send shutdown report to admin: %s", e)
+    return report
 
-# Add handlers
-application.add_handler(CommandHandler('start', start))
-application.add_handler(CommandHandler('admin', admin_command, filters=filters.User(ADMIN_ID)))
-application.add_handler(CommandHandler('broadcast', broadcast_command, filters=filters.User(ADMIN_ID)))
-application.add_handler(CommandHandler('stats', stats_command, filters=filters.User(ADMIN_ID)))
-application.add_handler(CallbackQueryHandler(button_handler))
 
-# Admin input handling (text messages when in specific admin states)
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), handle_admin_input))
+async def run_bot(application: Application):
+    """Polls for updates until SIGTERM/SIGINT, then shuts down gracefully."""
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_signal.set)
 
-# User withdrawal input handling (text/photo messages when in specific withdrawal states)
-application.add_handler(MessageHandler(
-    (filters.TEXT | filters.PHOTO) & ~filters.COMMAND & ~filters.User(ADMIN_ID),
-    handle_withdrawal_input_wrapper
-))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.updater.start_polling(poll_interval=1, timeout=30)  # Poll every 1 second, with a 30 second timeout
+        await application.start()
+
+        await stop_signal.wait()
+        logger.info("Shutdown signal received. Draining in-flight work.")
+        await graceful_shutdown(application)
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()  # Waits for running jobs and tasks created with create_task()
+        await application.shutdown()  # Flushes persistence
+
+
+def build_application(token=None):
+    """Builds the Telegram Application with all handlers and jobs registered.
+
+    Nothing here talks to Telegram or MongoDB; connections are opened lazily
+    once the application starts.
+    """
+    token = token or TOKEN
+    if not token:
+        raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set!")
+
+    application = (
+        Application.builder()
+        .token(token)
+        .persistence(MongoPersistence(ptb_persistence))
+        .request(TimedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .concurrent_updates(GuardedUpdateProcessor(1))
+        .build()
+    )
+
+    # Add handlers
+    application.add_handler(CommandHandler('start', instrument(start)))
+    application.add_handler(CommandHandler('admin', instrument(admin_command), filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler('broadcast', instrument(broadcast_command), filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler('stats', instrument(stats_command), filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler('export', instrument(export_command), filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler('profile', instrument(profile_command), filters=filters.User(ADMIN_ID)))
+    application.add_handler(CallbackQueryHandler(instrument(button_handler)))
+
+    # Admin input handling (text messages when in specific admin states)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), instrument(handle_admin_input)))
+
+    # User withdrawal input handling (text/photo messages when in specific withdrawal states)
+    application.add_handler(MessageHandler(
+        (filters.TEXT | filters.PHOTO) & ~filters.COMMAND & ~filters.User(ADMIN_ID),
+        instrument(handle_withdrawal_input_wrapper)
+    ))
+
+    application.add_error_handler(with_log_context(error_handler))
+
+    # Setup job queue for cleanup
+    job_queue = application.job_queue
+    if job_queue is not None:
+        if USER_CLEANUP_ENABLED:
+            job_queue.run_repeating(with_log_context(cleanup_old_data), interval=timedelta(days=1), first=0,
+                                    data={"application_instance": application})  # Changed to daily for less frequent polling
+        job_queue.run_repeating(with_log_context(process_notification_outbox), interval=OUTBOX_POLL_INTERVAL, first=OUTBOX_POLL_INTERVAL)
+        job_queue.run_repeating(with_log_context(archive_completed_withdrawals), interval=timedelta(days=1), first=timedelta(minutes=10))
+        # Runs once the application has started, then picks up broadcasts whose owner died
+        job_queue.run_repeating(with_log_context(resume_broadcasts), interval=BROADCAST_LEASE, first=0)
+    else:
+        logger.error("JobQueue is not initialized. Ensure python-telegram-bot[job-queue] is installed.")
+
+    return application
 
-application.add_error_handler(error_handler)
 
-# Setup job queue for cleanup
-job_queue = application.job_queue
-if job_queue is not None:
-    job_queue.run_repeating(cleanup_old_data, interval=timedelta(days=1), first=0,
-                            data={"application_instance": application})  # Changed to daily for less frequent polling
-else:
-    logger.error("JobQueue is not initialized. Ensure python-telegram-bot[job-queue] is installed.")
+def close_client():
+    """Closes the MongoDB connection if one was opened."""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def benchmark_startup(runs=5):
+    """Prints cold import and build_application() timings.
+
+    Run with ``python bot.py --benchmark-startup``. Neither step needs a live
+    MongoDB or a real bot token.
+    """
+    import_times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import bot"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True
+        )
+        import_times.append(time.perf_counter() - started)
+
+    build_times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        build_application(token="123456:BENCHMARK")
+        build_times.append(time.perf_counter() - started)
+
+    print(f"Cold import (incl. interpreter start): best {min(import_times) * 1000:.1f} ms, "
+          f"mean {sum(import_times) / runs * 1000:.1f} ms over {runs} runs")
+    print(f"build_application(): best {min(build_times) * 1000:.1f} ms, "
+          f"mean {sum(build_times) / runs * 1000:.1f} ms over {runs} runs")
 
 
 # Flask routes for health check ONLY
@@ -909,17 +2800,57 @@ else:
 def health_check():
     return "EarnBot is running!"
 
+@app.route('/ready')
+def readiness_check():
+    """Fails as soon as a shutdown starts so traffic moves away before the bot stops."""
+    if ready.is_set():
+        return "ready"
+    return ("shutting down" if shutdown_requested.is_set() else "starting"), 503
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of the bot's counters."""
+    dropped, soft_replies = throttle.snapshot()
+    lines = [
+        "# HELP earnbot_throttled_updates_total Updates dropped by the flood throttle.",
+        "# TYPE earnbot_throttled_updates_total counter",
+    ]
+    lines += [f'earnbot_throttled_updates_total{{limit="{key}"}} {count}' for key, count in sorted(dropped.items())]
+    lines += [
+        "# HELP earnbot_throttle_soft_replies_total Slow-down notices sent to throttled users.",
+        "# TYPE earnbot_throttle_soft_replies_total counter",
+        f"earnbot_throttle_soft_replies_total {soft_replies}",
+    ]
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 # NO WEBHOOK ROUTE HERE
 
+_flask_server = None
+
 def run_flask_server():
     """Runs the Flask health check server."""
+    global _flask_server
     PORT = int(os.environ.get('PORT', 8000))
-    logger.info(f"Starting Flask server on port {PORT}")
+    logger.info("Starting Flask server on port %s", PORT)
     # Using a simple development server for health check.
     # For production, consider using Gunicorn or similar.
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    _flask_server = make_server('0.0.0.0', PORT, app, threaded=True)
+    _flask_server.serve_forever()
+
+def stop_flask_server():
+    """Stops serving once any request in progress has been answered."""
+    if _flask_server is not None:
+        _flask_server.shutdown()
+
 
 if __name__ == '__main__':
+    if '--benchmark-startup' in sys.argv:
+        benchmark_startup()
+        sys.exit(0)
+
+    setup_logging()
+    application = build_application()
+
     # 1. Start the Flask server in a separate thread.
     # This thread will handle health check requests.
     flask_server_thread = Thread(target=run_flask_server)
@@ -928,14 +2859,14 @@ if __name__ == '__main__':
 
     logger.info("Starting Telegram bot in polling mode.")
     # 2. Start the Telegram bot in polling mode in the main thread.
-    # This will block the main thread, but Flask is running in a separate thread.
+    # This blocks until SIGTERM/SIGINT, after which run_bot() drains in-flight work.
     try:
-        application.run_polling(poll_interval=1, timeout=30)  # Poll every 1 second, with a 30 second timeout
-    except KeyboardInterrupt:
-        logger.info("Bot process interrupted. Shutting down.")
-        application.stop()  # Stop the PTB application
-        client.close()  # Close MongoDB connection
+        asyncio.run(run_bot(application))
     except Exception as e:
-        logger.critical(f"An unhandled error occurred in the polling loop: {e}", exc_info=True)
-        application.stop()
-        client.close()
+        logger.critical("An unhandled error occurred in the polling loop: %s", e, exc_info=True)
+    finally:
+        stop_flask_server()
+        shortener_executor.shutdown(wait=False, cancel_futures=True)
+        profile_executor.shutdown(wait=False, cancel_futures=True)
+        close_client()  # Close MongoDB connection
+        stop_logging()